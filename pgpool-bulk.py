@@ -0,0 +1,74 @@
+import codecs
+import logging
+import os
+
+import sys
+from flask import Flask
+
+from pgpool.config import args
+from pgpool.models import init_database, bulk_update_accounts, bulk_operations
+from pgpool.utils import load_usernames
+
+logging.basicConfig(level=logging.INFO,
+    format='%(asctime)s [%(threadName)16s][%(module)14s][%(levelname)8s] %(message)s')
+log = logging.getLogger(__name__)
+
+app = Flask(__name__)
+
+
+def parse_filters(filter_args):
+    filters = {}
+    for f in filter_args:
+        if '=' not in f:
+            log.error("Filter {} must be given as key=value.".format(f))
+            sys.exit(1)
+        key, value = f.split('=', 1)
+        filters[key.strip()] = value.strip()
+    return filters
+
+
+# ---------------------------------------------------------------------------
+
+log.info("PGPool Bulk Operations starting up...")
+
+operation = args.bulk_operation
+if operation not in bulk_operations:
+    log.error("You must specify a bulk operation with --bulk-operation. One of [{}].".format(', '.join(bulk_operations)))
+    sys.exit(1)
+
+usernames = None
+filters = None
+if args.usernames_file:
+    if not os.path.isfile(args.usernames_file):
+        log.error("File {} does not exist.".format(args.usernames_file))
+        sys.exit(1)
+    with codecs.open(args.usernames_file, mode='r', encoding='utf-8') as f:
+        usernames = load_usernames(f)
+    log.info("Loaded {} usernames from file {}.".format(len(usernames), args.usernames_file))
+elif args.filter:
+    filters = parse_filters(args.filter)
+else:
+    log.error("You must either specify a --usernames-file or at least one --filter.")
+    sys.exit(1)
+
+value = None
+if operation == 'condition':
+    if not args.condition:
+        log.error("You must specify the account condition with --condition.")
+        sys.exit(1)
+    value = args.condition
+elif operation == 'level':
+    if not args.level:
+        log.error("You must specify the trainer level with --level.")
+        sys.exit(1)
+    value = args.level
+
+db = init_database(app)
+
+try:
+    num = bulk_update_accounts(operation, value, usernames, filters)
+except ValueError as e:
+    log.error(e)
+    sys.exit(1)
+
+log.info("Done. Bulk operation {} affected {} accounts.".format(operation, num))
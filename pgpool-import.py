@@ -6,7 +6,7 @@ import sys
 from flask import Flask
 
 from pgpool.config import args
-from pgpool.models import init_database, Account
+from pgpool.models import init_database, Account, account_conditions, next_change_seq
 
 logging.basicConfig(level=logging.INFO,
     format='%(asctime)s [%(threadName)16s][%(module)14s][%(levelname)8s] %(message)s')
@@ -50,23 +50,8 @@ def load_accounts_file(filename):
 
 
 def force_account_condition(account):
-    account.ban_flag = 0
-    if args.condition == 'good':
-        account.banned = 0
-        account.shadowbanned = 0
-        account.captcha = 0
-    elif args.condition == 'banned':
-        account.banned = 1
-        account.shadowbanned = 0
-        account.captcha = 0
-    elif args.condition == 'blind':
-        account.banned = 0
-        account.shadowbanned = 1
-        account.captcha = 0
-    elif args.condition == 'captcha':
-        account.banned = 0
-        account.shadowbanned = 0
-        account.captcha = 1
+    for name, value in account_conditions[args.condition].items():
+        setattr(account, name, value)
 
 
 # ---------------------------------------------------------------------------
@@ -89,14 +74,19 @@ num_imported = 0
 
 for acc in accounts:
     username = acc['username']
-    account, created = Account.get_or_create(username=username)
+    with db.atomic():
+        # Take the sequence number first like every other writer
+        change_seq = next_change_seq()
+        account, created = Account.get_or_create(username=username)
+        if created:
+            account.auth_service = acc['auth_service']
+            account.password = acc['password']
+            account.level = args.level
+            account.change_seq = change_seq
+            if args.condition != 'unknown':
+                force_account_condition(account)
+            account.save()
     if created:
-        account.auth_service = acc['auth_service']
-        account.password = acc['password']
-        account.level = args.level
-        if args.condition != 'unknown':
-            force_account_condition(account)
-        account.save()
         addl_logmsg = ""
         if args.level:
             addl_logmsg += " | Forced trainer level: {}".format(args.level)
@@ -3,15 +3,17 @@ import logging
 from Queue import Queue
 from threading import Thread
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from werkzeug.exceptions import abort
 
 from pgpool.config import cfg_get
 from pgpool.console import print_status
-from pgpool.models import init_database, db_updater, Account, auto_release, flaskDb
+from pgpool.eventstream import subscribe, stream
+from pgpool.models import init_database, db_updater, Account, auto_release, \
+    bulk_update_accounts, reporting_db
 
 # ---------------------------------------------------------------------------
-from pgpool.utils import parse_bool, rss_mem_size
+from pgpool.utils import parse_bool, rss_mem_size, load_usernames
 
 logging.basicConfig(level=logging.INFO,
     format='%(asctime)s [%(threadName)16s][%(module)14s][%(levelname)8s] %(message)s')
@@ -53,7 +55,7 @@ def status():
         lines += "<th>{}</th>".format(h)
 
     for c in conditions:
-        cursor = flaskDb.database.execute_sql('''
+        cursor = reporting_db().execute_sql('''
             select (case when level < 30 then "low" when level >= 30 then "high" else "unknown" end) as category, count(*) from account
             where {}
             group by category
@@ -102,6 +104,52 @@ def get_accounts():
     return jsonify(accounts[0] if accounts and count == 1 else accounts)
 
 
+@app.route('/changes', methods=['GET'])
+def get_changes():
+    try:
+        since = int(request.args.get('since', 0))
+        limit = int(request.args.get('limit', 100))
+        accounts = Account.get_changes(since, limit)
+    except ValueError as e:
+        log.error("Changes request from {} failed: {}".format(request.remote_addr, e))
+        return str(e), 400
+    return jsonify({
+        'cursor': accounts[-1]['change_seq'] if accounts else since,
+        'accounts': accounts
+    })
+
+
+@app.route('/events/stream', methods=['GET'])
+def event_stream():
+    system_id = request.args.get('system_id')
+    event_types = request.args.get('type')
+    event_types = set(event_types.split(',')) if event_types else None
+    log.info("Event stream subscriber connected from {}".format(request.remote_addr))
+    subscriber = subscribe(system_id, event_types)
+    return Response(stream(subscriber), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/account/search', methods=['GET'])
+def search_accounts():
+    filters = request.args.to_dict()
+    cursor = filters.pop('cursor', None)
+    limit = filters.pop('limit', 100)
+    fields = filters.pop('fields', None)
+    fields = fields.split(',') if fields else None
+    include_sensitive = parse_bool(filters.pop('include_sensitive', None))
+    try:
+        limit = int(limit)
+        accounts, next_cursor = Account.search(filters, cursor, limit, fields, include_sensitive)
+    except ValueError as e:
+        log.error("Search request from {} failed: {}".format(request.remote_addr, e))
+        return str(e), 400
+    return jsonify({
+        'cursor': next_cursor,
+        'accounts': accounts
+    })
+
+
 @app.route('/account/release', methods=['POST'])
 def release_accounts():
     data = json.loads(request.data)
@@ -132,6 +180,32 @@ def accounts_update():
     return 'ok'
 
 
+@app.route('/account/bulk', methods=['POST'])
+def accounts_bulk():
+    if 'usernames' in request.files:
+        # Form upload of a username list, other form fields are parameters
+        params = request.form.to_dict()
+        usernames = load_usernames(request.files['usernames'].read().decode('utf-8').splitlines())
+        filters = None
+    else:
+        params = json.loads(request.data)
+        usernames = params.get('usernames')
+        filters = params.get('filter')
+
+    operation = params.get('operation')
+    try:
+        num = bulk_update_accounts(operation, params.get('value'), usernames, filters)
+    except ValueError as e:
+        log.error("Bulk request from {} failed: {}".format(request.remote_addr, e))
+        return str(e), 400
+
+    log.info("Bulk operation {} from {} affected {} accounts.".format(operation, request.remote_addr, num))
+    return jsonify({
+        'operation': operation,
+        'affected': num
+    })
+
+
 def run_server():
     app.run(threaded=True, host=cfg_get('host'), port=cfg_get('port'))
 
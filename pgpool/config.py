@@ -16,9 +16,18 @@ cfg = {
     'db_user': '',
     'db_pass': '',
     'db_max_connections': 20,
+    'replica_db_host': None,            # Optional read replica for reporting queries (status, search, changes)
+    'replica_db_port': None,            # Replica settings that are not given default to the primary ones
+    'replica_db_name': None,
+    'replica_db_user': None,
+    'replica_db_pass': None,
+    'replica_db_max_connections': 20,
     'log_updates': True,
     'account_release_timeout': 120,     # Accounts are being released automatically after this many minutes from last update
-    'max_queue_size': 50                # Block update requests if queue already has this many items
+    'max_queue_size': 50,               # Block update requests if queue already has this many items
+    'event_stream_buffer': 1000,        # Drop /events/stream subscribers that fall this many events behind
+    'event_stream_keepalive': 15,       # Seconds between keepalive comments on idle event streams
+    'bulk_chunk_size': 1000             # Bulk operations update/delete this many accounts per statement
 }
 
 
@@ -38,12 +47,26 @@ parser.add_argument('-l', '--level',
                     help=('Trainer level of imported accounts.'),
                     type=int, default=None)
 parser.add_argument('-cnd', '--condition',
-                    help=('Account condition of imported accounts. One of [unknown, good, banned, blind, captcha]. Default: unknown'),
-                    default='unknown')
+                    help=('Account condition of imported accounts or to set with bulk operation condition. '
+                          'One of [unknown, good, banned, blind, captcha]. Default for imports: unknown'),
+                    default=None)
+parser.add_argument('-b', '--bulk-operation',
+                    help=('Bulk operation to perform with pgpool-bulk.py. One of [condition, reset_system_id, level, delete].'),
+                    default=None)
+parser.add_argument('-u', '--usernames-file',
+                    help=('File with one username per line to apply the bulk operation to.'),
+                    default=None)
+parser.add_argument('-f', '--filter',
+                    help=('Apply the bulk operation to accounts matching this filter, e.g. "system_id=myscanner" '
+                          'or "max_level=29". Can be given multiple times.'),
+                    action='append', default=[])
 args = parser.parse_args()
 
-args.condition = args.condition.lower()
-if args.condition != 'unknown' and not args.level:
+if args.condition:
+    args.condition = args.condition.lower()
+elif args.import_csv:
+    args.condition = 'unknown'
+if args.import_csv and args.condition != 'unknown' and not args.level:
     log.error("You must also specify a trainer level with --level if you force an account condition with --condition.")
     sys.exit(1)
 
@@ -12,7 +12,8 @@ from threading import Thread
 
 from peewee import fn
 
-from pgpool.models import Account, flaskDb
+from pgpool.eventstream import get_subscriber_count
+from pgpool.models import reporting_db
 from pgpool.utils import rss_mem_size
 
 log = logging.getLogger(__name__)
@@ -74,7 +75,8 @@ def print_status(initial_display, db_updates_queue):
 
 
 def print_stats(lines, db_updates_queue):
-    lines.append("Mem Usage: {} | DB Queue Size: {}\n".format(rss_mem_size(), db_updates_queue.qsize()))
+    lines.append("Mem Usage: {} | DB Queue Size: {} | Event Stream Subscribers: {}\n".format(
+        rss_mem_size(), db_updates_queue.qsize(), get_subscriber_count()))
 
     try:
         lines.append("Condition     | L1-29   | L30+    | unknown | TOTAL")
@@ -94,7 +96,7 @@ def print_stats(lines, db_updates_queue):
 
 
 def print_stats_line(lines, name, condition):
-    cursor = flaskDb.database.execute_sql('''
+    cursor = reporting_db().execute_sql('''
         select (case when level < 30 then "low" when level >= 30 then "high" else "unknown" end) as category, count(*) from account
         where {}
         group by category
@@ -113,7 +115,7 @@ def print_stats_line(lines, name, condition):
 
 
 def print_system_ids_overview(lines):
-    cursor = flaskDb.database.execute_sql('select system_id, count(*) from account group by system_id')
+    cursor = reporting_db().execute_sql('select system_id, count(*) from account group by system_id')
     stats = {}
     for row in cursor.fetchall():
         if row[0]:
@@ -0,0 +1,82 @@
+import json
+import logging
+from Queue import Queue, Full, Empty
+from threading import Lock
+
+from pgpool.config import cfg_get
+
+log = logging.getLogger(__name__)
+
+subscribers = []
+subscribers_lock = Lock()
+
+
+class Subscriber(object):
+
+    def __init__(self, system_id=None, event_types=None):
+        self.system_id = system_id
+        self.event_types = event_types
+        # Bounded so a slow consumer can never make PGPool buffer unlimited events
+        self.queue = Queue(maxsize=cfg_get('event_stream_buffer'))
+        self.dropped = False
+
+    def wants(self, event):
+        if self.system_id and self.system_id != event['system_id']:
+            return False
+        if self.event_types and event['type'] not in self.event_types:
+            return False
+        return True
+
+
+def get_subscriber_count():
+    return len(subscribers)
+
+
+def subscribe(system_id=None, event_types=None):
+    subscriber = Subscriber(system_id, event_types)
+    subscribers_lock.acquire()
+    subscribers.append(subscriber)
+    subscribers_lock.release()
+    return subscriber
+
+
+def unsubscribe(subscriber):
+    subscribers_lock.acquire()
+    if subscriber in subscribers:
+        subscribers.remove(subscriber)
+    subscribers_lock.release()
+
+
+def publish(event):
+    subscribers_lock.acquire()
+    current = list(subscribers)
+    subscribers_lock.release()
+
+    for subscriber in current:
+        if not subscriber.wants(event):
+            continue
+        try:
+            subscriber.queue.put_nowait(event)
+        except Full:
+            log.warning("Event stream subscriber fell {} events behind. Dropping it.".format(
+                subscriber.queue.maxsize))
+            subscriber.dropped = True
+            unsubscribe(subscriber)
+
+
+def stream(subscriber):
+    # Generator producing server-sent events for one subscriber.
+    keepalive = cfg_get('event_stream_keepalive')
+    try:
+        while not subscriber.dropped:
+            try:
+                event = subscriber.queue.get(timeout=keepalive)
+            except Empty:
+                # Comment line keeps proxies from closing the connection and
+                # lets us notice disconnected clients.
+                yield ": keepalive\n\n"
+                continue
+            yield "id: {}\nevent: {}\ndata: {}\n\n".format(event['id'], event['type'], json.dumps(event))
+        yield "event: dropped\ndata: {}\n\n"
+    finally:
+        unsubscribe(subscriber)
@@ -1,26 +1,54 @@
 import copy
+import json
 import logging
 import time
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from datetime import datetime, timedelta
 from threading import Lock
 
 from peewee import DateTimeField, CharField, SmallIntegerField, IntegerField, \
-    DoubleField, BooleanField, InsertQuery
+    DoubleField, BooleanField, BigIntegerField, InsertQuery, fn, SQL
 from playhouse.flask_utils import FlaskDB
 from playhouse.migrate import migrate, MySQLMigrator
 from playhouse.pool import PooledMySQLDatabase
 from playhouse.shortcuts import RetryOperationalError
 
 from pgpool.config import cfg_get
+from pgpool.eventstream import publish
 from pgpool.utils import cmp_bool
 
 log = logging.getLogger(__name__)
 
 flaskDb = FlaskDB()
 
+# Optional read replica for reporting queries. None if not configured.
+replica_db = None
+
 request_lock = Lock()
 
-db_schema_version = 2
+# Every account modification and deletion gets the next number of a
+# monotonic sequence which clients use as cursor for /changes. Numbers are
+# allocated from a counter row in the database, see next_change_seq().
+
+# Maximum number of accounts returned by one /changes or /account/search request
+max_changes_limit = 1000
+max_search_limit = 1000
+
+# Account fields only returned if explicitly asked for
+sensitive_fields = ['password', 'email']
+
+# Account health fields forced by the different account conditions
+account_conditions = {
+    'unknown': {'ban_flag': None, 'banned': None, 'shadowbanned': None, 'captcha': None},
+    'good': {'ban_flag': False, 'banned': False, 'shadowbanned': False, 'captcha': False},
+    'banned': {'ban_flag': False, 'banned': True, 'shadowbanned': False, 'captcha': False},
+    'blind': {'ban_flag': False, 'banned': False, 'shadowbanned': True, 'captcha': False},
+    'captcha': {'ban_flag': False, 'banned': False, 'shadowbanned': False, 'captcha': True}
+}
+
+bulk_operations = ['condition', 'reset_system_id', 'level', 'delete']
+
+db_schema_version = 4
 
 class MyRetryDB(RetryOperationalError, PooledMySQLDatabase):
     pass
@@ -41,6 +69,11 @@ class Version(flaskDb.Model):
         primary_key = False
 
 
+class ChangeCounter(flaskDb.Model):
+    # Single row holding the last allocated change sequence number
+    value = BigIntegerField(default=0)
+
+
 class Account(flaskDb.Model):
     auth_service = Utf8mb4CharField(max_length=6, default='ptc')
     username = Utf8mb4CharField(primary_key=True)
@@ -77,6 +110,8 @@ class Account(flaskDb.Model):
     eggs = SmallIntegerField(null=True)
     incubators = SmallIntegerField(null=True)
     lures = SmallIntegerField(null=True)
+    # sequence number of last modification, see next_change_seq()
+    change_seq = BigIntegerField(index=True, default=0)
 
     @staticmethod
     def get_accounts(system_id, count=1, min_level=1, max_level=40, reuse=False, banned_or_new=False):
@@ -125,16 +160,75 @@ class Account(flaskDb.Model):
                     old_system_id = account.system_id
                     account.system_id = system_id
                     account.last_modified = datetime.now()
-                    account.save()
+                    with flaskDb.database.atomic():
+                        account.change_seq = next_change_seq()
+                        account.save()
 
                     if old_system_id != system_id:
-                        new_account_event(account, "Got assigned to [{}]".format(system_id))
+                        new_account_event(account, "Got assigned to [{}]".format(system_id), 'assigned')
 
                     count -= 1
 
         request_lock.release()
         return accounts
 
+    @staticmethod
+    def get_changes(since, limit=100):
+        # Changed accounts and tombstones of deleted ones, in sequence order.
+        if limit < 1:
+            raise ValueError("Limit must be at least 1.")
+        limit = min(limit, max_changes_limit)
+        query = Account.select().where(Account.change_seq > since).order_by(Account.change_seq).limit(limit)
+        changes = [dict(account_to_dict(account), deleted=False) for account in on_replica(query)]
+        query = DeletedAccount.select().where(DeletedAccount.change_seq > since).order_by(
+            DeletedAccount.change_seq).limit(limit)
+        changes += [deleted_account_to_dict(deleted) for deleted in on_replica(query)]
+        changes.sort(key=lambda change: change['change_seq'])
+        return changes[:limit]
+
+    @staticmethod
+    def search(filters, cursor=None, limit=100, fields=None, include_sensitive=False):
+        # Seek pagination on (last_modified, username): every page is a range
+        # scan on the last_modified index (InnoDB appends the primary key to
+        # it), no matter how deep the client pages.
+        limit = min(limit, max_search_limit)
+        if fields is None:
+            fields = [f for f in Account._meta.sorted_field_names
+                      if include_sensitive or f not in sensitive_fields]
+        unknown = [f for f in fields if f not in Account._meta.fields]
+        if unknown:
+            raise ValueError("Unknown account fields: {}".format(', '.join(unknown)))
+        if not include_sensitive:
+            # Filtering on them would give them away just as well
+            used = set(fields) | set(key[4:] if key[:4] in ('min_', 'max_') else key for key in filters)
+            hidden = [f for f in sensitive_fields if f in used]
+            if hidden:
+                raise ValueError("Fields {} need include_sensitive=true.".format(', '.join(hidden)))
+        if limit < 1:
+            raise ValueError("Limit must be at least 1.")
+        # Always fetch the sort key to build the next cursor
+        columns = [Account._meta.fields[f] for f in set(fields) | set(['last_modified', 'username'])]
+
+        query = Account.select(*columns).where(account_filter(filters))
+        if cursor:
+            last_modified, username = decode_search_cursor(cursor)
+            query = query.where((Account.last_modified >= last_modified) &
+                                SQL('(last_modified, username) > (%s, %s)', last_modified, username))
+        query = query.order_by(Account.last_modified, Account.username).limit(limit)
+        query = on_replica(query)
+
+        accounts = list(query)
+        next_cursor = encode_search_cursor(accounts[-1]) if len(accounts) == limit else None
+        return [account_to_dict(account, fields) for account in accounts], next_cursor
+
+
+class DeletedAccount(flaskDb.Model):
+    # Tombstones of deleted accounts so /changes can report deletions
+    username = Utf8mb4CharField(index=True)
+    system_id = Utf8mb4CharField(max_length=64, null=True)
+    deleted = DateTimeField(default=datetime.now)
+    change_seq = BigIntegerField(index=True)
+
 
 class Event(flaskDb.Model):
     timestamp = DateTimeField(default=datetime.now, index=True)
@@ -146,6 +240,59 @@ class Event(flaskDb.Model):
 # ===========================================================================
 
 
+def account_to_dict(account, fields=None):
+    # Passwords never leave PGPool except through /account/request
+    if fields is None:
+        fields = [f for f in Account._meta.sorted_field_names if f not in sensitive_fields]
+    return {f: getattr(account, f) for f in fields}
+
+
+def deleted_account_to_dict(deleted):
+    return {
+        'username': deleted.username,
+        'system_id': deleted.system_id,
+        'last_modified': deleted.deleted,
+        'change_seq': deleted.change_seq,
+        'deleted': True
+    }
+
+
+def encode_search_cursor(account):
+    key = [account.last_modified.strftime('%Y-%m-%d %H:%M:%S.%f'), account.username]
+    return urlsafe_b64encode(json.dumps(key))
+
+
+def decode_search_cursor(cursor):
+    try:
+        last_modified, username = json.loads(urlsafe_b64decode(str(cursor)))
+        return datetime.strptime(last_modified, '%Y-%m-%d %H:%M:%S.%f'), username
+    except Exception:
+        raise ValueError("Invalid cursor: {}".format(cursor))
+
+
+def init_change_counter():
+    # Makes sure the counter row exists and is not behind existing numbers.
+    max_seq = max(Account.select(fn.MAX(Account.change_seq)).scalar() or 0,
+                  DeletedAccount.select(fn.MAX(DeletedAccount.change_seq)).scalar() or 0)
+    with flaskDb.database.atomic():
+        if not ChangeCounter.select().exists():
+            ChangeCounter.create(value=max_seq)
+        else:
+            ChangeCounter.update(value=fn.GREATEST(ChangeCounter.value, max_seq)).execute()
+    log.info("Account change sequence is at {}.".format(ChangeCounter.select(ChangeCounter.value).scalar()))
+
+
+def next_change_seq(count=1):
+    # Reserves count consecutive sequence numbers and returns the first one.
+    # Must be called inside the transaction that writes the change, before
+    # touching any account rows: the counter row stays locked until commit,
+    # so changes of all PGPool processes become visible in sequence order.
+    db = flaskDb.database
+    ChangeCounter.update(value=fn.LAST_INSERT_ID(ChangeCounter.value + count)).execute()
+    last = db.execute_sql('SELECT LAST_INSERT_ID()').fetchone()[0]
+    return last - count + 1
+
+
 def init_database(app):
     log.info('Connecting to MySQL database on %s:%i...',
              cfg_get('db_host'), cfg_get('db_port'))
@@ -177,9 +324,48 @@ def init_database(app):
     # Last, fix database encoding
     verify_table_encoding(db)
 
+    init_change_counter()
+
+    init_replica_database(app)
+
     return db
 
 
+def init_replica_database(app):
+    global replica_db
+    if not cfg_get('replica_db_host'):
+        return
+    log.info('Connecting to MySQL read replica on %s:%i...',
+             cfg_get('replica_db_host'), cfg_get('replica_db_port') or cfg_get('db_port'))
+    replica_db = MyRetryDB(
+        cfg_get('replica_db_name') or cfg_get('db_name'),
+        user=cfg_get('replica_db_user') or cfg_get('db_user'),
+        password=cfg_get('replica_db_pass') or cfg_get('db_pass'),
+        host=cfg_get('replica_db_host'),
+        port=cfg_get('replica_db_port') or cfg_get('db_port'),
+        max_connections=cfg_get('replica_db_max_connections'),
+        stale_timeout=300,
+        charset='utf8mb4')
+
+    # FlaskDB only takes care of the primary, return replica connections to
+    # the pool ourselves.
+    @app.teardown_request
+    def close_replica_db(exc):
+        if not replica_db.is_closed():
+            replica_db.close()
+
+
+def reporting_db():
+    # Database for read-only reporting queries. Allocation and updates always
+    # stay on the primary.
+    return replica_db or flaskDb.database
+
+
+def on_replica(query):
+    query.database = reporting_db()
+    return query
+
+
 def verify_table_encoding(db):
     with db.execution_context():
         cmd_sql = '''
@@ -223,11 +409,34 @@ def migrate_database(db, old_ver):
             migrator.rename_column('event', 'type', 'entity_type')
         )
 
+    if old_ver < 3:
+        migrate(
+            migrator.add_column('account', 'change_seq',
+                                BigIntegerField(default=0)),
+            migrator.add_index('account', ('change_seq',), False)
+        )
+        backfill_change_seq(db)
+
+    if old_ver < 4:
+        db.create_tables([ChangeCounter, DeletedAccount], safe=True)
+        # Accounts imported while on version 3 did not get a number.
+        backfill_change_seq(db)
+
     Version.update(val=db_schema_version).where(
         Version.key == 'schema_version').execute()
     log.info("Done migrating database.")
 
 
+def backfill_change_seq(db):
+    # Gives every account without a change sequence number its own, so they
+    # show up in /changes.
+    with db.atomic():
+        db.execute_sql('SET @change_seq = (SELECT COALESCE(MAX(change_seq), 0) FROM account)')
+        num = db.execute_sql('UPDATE account SET change_seq = (@change_seq := @change_seq + 1) '
+                             'WHERE change_seq = 0 ORDER BY username').rowcount
+    log.info("Assigned change sequence numbers to {} accounts.".format(num))
+
+
 def migrate_varchar_columns(db, *fields):
     stmts = []
     cols = []
@@ -277,47 +486,62 @@ def db_updater(q, db):
             time.sleep(5)
 
 
-def new_account_event(acc, description):
+def new_account_event(acc, description, event_type, system_id=None):
     description = (description[:189] + '..') if len(description) > 189 else description
     evt = Event(entity_type='account', entity_id=acc.username, description=description)
     evt.save()
     log.info("Event for account {}: {}".format(acc.username, description))
+    publish({
+        'id': evt.id,
+        'timestamp': time.mktime(evt.timestamp.timetuple()),
+        'type': event_type,
+        'username': acc.username,
+        'system_id': system_id or acc.system_id,
+        'description': description
+    })
 
 
 def eval_acc_state_changes(acc_prev, acc_curr, metadata):
     level_prev = acc_prev.level
     level_curr = acc_curr.level
     if level_prev is not None and level_curr is not None and level_prev < level_curr:
-        new_account_event(acc_curr, "Level {} reached".format(level_curr))
+        new_account_event(acc_curr, "Level {} reached".format(level_curr), 'level_up')
 
     got_true = cmp_bool(acc_prev.warn, acc_curr.warn)
     if got_true is not None:
-        new_account_event(acc_curr, "Got warn flag :-/") if got_true else new_account_event(acc_curr,
-                                                                                            "Warn flag lifted :-)")
+        new_account_event(acc_curr, "Got warn flag :-/", 'warn') if got_true else new_account_event(acc_curr,
+                                                                                                    "Warn flag lifted :-)",
+                                                                                                    'warn_lifted')
 
     got_true = cmp_bool(acc_prev.shadowbanned, acc_curr.shadowbanned)
     if got_true is not None:
-        new_account_event(acc_curr, "Got shadowban flag :-(") if got_true else new_account_event(acc_curr,
-                                                                                                 "Shadowban flag lifted :-)")
+        new_account_event(acc_curr, "Got shadowban flag :-(", 'shadowban') if got_true else new_account_event(acc_curr,
+                                                                                                              "Shadowban flag lifted :-)",
+                                                                                                              'shadowban_lifted')
 
     got_true = cmp_bool(acc_prev.banned, acc_curr.banned)
     if got_true is not None:
-        new_account_event(acc_curr, "Got banned :-(((") if got_true else new_account_event(acc_curr, "Ban lifted :-)))")
+        new_account_event(acc_curr, "Got banned :-(((", 'banned') if got_true else new_account_event(acc_curr,
+                                                                                                     "Ban lifted :-)))",
+                                                                                                     'ban_lifted')
 
     got_true = cmp_bool(acc_prev.ban_flag, acc_curr.ban_flag)
     if got_true is not None:
-        new_account_event(acc_curr, "Got ban flag :-X") if got_true else new_account_event(acc_curr,
-                                                                                           "Ban flag lifted :-O")
+        new_account_event(acc_curr, "Got ban flag :-X", 'ban_flag') if got_true else new_account_event(acc_curr,
+                                                                                                       "Ban flag lifted :-O",
+                                                                                                       'ban_flag_lifted')
 
     got_true = cmp_bool(acc_prev.captcha, acc_curr.captcha)
     if got_true is not None:
-        new_account_event(acc_curr, "Got CAPTCHA'd :-|") if got_true else new_account_event(acc_curr,
-                                                                                            "CAPTCHA solved :-)")
+        new_account_event(acc_curr, "Got CAPTCHA'd :-|", 'captcha') if got_true else new_account_event(acc_curr,
+                                                                                                       "CAPTCHA solved :-)",
+                                                                                                       'captcha_solved')
 
     if acc_prev.system_id is not None and acc_curr.system_id is None:
         new_account_event(acc_curr, "Got released from [{}]: {}".format(acc_prev.system_id,
                                                                         metadata.get('_release_reason',
-                                                                                     'unknown reason')))
+                                                                                     'unknown reason')),
+                          'released', system_id=acc_prev.system_id)
 
         # if acc_prev.rareless_scans == 0 and acc_curr.rareless_scans > 0:
         #     new_account_event(acc_curr, "Started seeing only commons :-/")
@@ -328,6 +552,7 @@ def eval_acc_state_changes(acc_prev, acc_curr, metadata):
 def update_account(data, db):
     with db.atomic():
         try:
+            change_seq = next_change_seq()
             acc, created = Account.get_or_create(username=data['username'])
             acc_previous = copy.deepcopy(acc)
             metadata = {}
@@ -337,6 +562,7 @@ def update_account(data, db):
                 else:
                     metadata[key] = value
             acc.last_modified = datetime.now()
+            acc.change_seq = change_seq
             eval_acc_state_changes(acc_previous, acc, metadata)
             acc.save()
             if cfg_get('log_updates'):
@@ -369,20 +595,172 @@ def auto_release():
                 log.info("Releasing {} accounts that haven't been updated in the last {} minutes.".format(len(accounts),
                                                                                                          release_timeout))
             for acc in accounts:
-                new_account_event(acc, "Auto-releasing from [{}]".format(acc.system_id))
+                new_account_event(acc, "Auto-releasing from [{}]".format(acc.system_id), 'auto_released')
                 acc.system_id = None
                 acc.last_modified = datetime.now()
-                acc.save()
+                with flaskDb.database.atomic():
+                    acc.change_seq = next_change_seq()
+                    acc.save()
         except Exception as e:
             log.error(e)
 
         time.sleep(60)
 
 
+def account_filter(filters):
+    # Builds a where-condition from a dict of filters. Keys are either account
+    # fields (compared for equality, "null" matches NULL), account fields
+    # prefixed with min_ or max_ or "condition" with one of account_conditions.
+    condition = SQL('1')
+    for key, value in filters.items():
+        if key == 'condition':
+            # Same definitions as the status page
+            if value == 'unknown':
+                condition &= Account.level.is_null(True)
+            elif value == 'good':
+                condition &= (Account.banned == False) & (Account.shadowbanned == False)
+            elif value == 'blind':
+                condition &= (Account.banned == False) & (Account.shadowbanned == True)
+            elif value == 'banned':
+                condition &= Account.banned == True
+            elif value == 'captcha':
+                condition &= Account.captcha == True
+            else:
+                raise ValueError("Unknown account condition: {}".format(value))
+            continue
+
+        op = None
+        name = key
+        if key.startswith('min_') or key.startswith('max_'):
+            op = key[:3]
+            name = key[4:]
+        field = Account._meta.fields.get(name)
+        if field is None:
+            raise ValueError("Unknown account field: {}".format(name))
+        value = coerce_filter_value(field, value)
+        if op == 'min':
+            condition &= field >= value
+        elif op == 'max':
+            condition &= field <= value
+        elif value is None:
+            condition &= field.is_null(True)
+        else:
+            condition &= field == value
+    return condition
+
+
+def coerce_filter_value(field, value):
+    if value is None or value == 'null':
+        return None
+    if isinstance(field, BooleanField) and not isinstance(value, bool):
+        return str(value).lower() in ['1', 'true', 'yes']
+    if isinstance(field, DateTimeField) and isinstance(value, (int, long, float)):
+        return datetime.fromtimestamp(value)
+    return value
+
+
+def bulk_update_accounts(operation, value=None, usernames=None, filters=None):
+    # Applies a bulk operation with one set-based statement per chunk of
+    # accounts instead of saving every account on its own.
+    if operation == 'condition':
+        if value not in account_conditions:
+            raise ValueError("Unknown account condition: {}".format(value))
+        fields = dict(account_conditions[value])
+        description = "Forced condition {} on {} accounts"
+    elif operation == 'reset_system_id':
+        fields = {'system_id': None}
+        description = "Reset system ID of {1} accounts"
+    elif operation == 'level':
+        try:
+            fields = {'level': int(value)}
+        except (TypeError, ValueError):
+            raise ValueError("Invalid trainer level: {}".format(value))
+        description = "Set level {} on {} accounts"
+    elif operation == 'delete':
+        fields = None
+        description = "Deleted {1} accounts"
+    else:
+        raise ValueError("Unknown bulk operation: {}".format(operation))
+
+    if usernames is not None:
+        if not isinstance(usernames, list):
+            raise ValueError("Usernames must be a list.")
+        condition = SQL('1')
+        chunks = username_chunks(usernames)
+    elif filters is not None:
+        if not isinstance(filters, dict):
+            raise ValueError("Filter must be an object of account fields and values.")
+        condition = account_filter(filters)
+        chunks = filtered_username_chunks(condition)
+    else:
+        raise ValueError("Bulk operations need a filter or a list of usernames.")
+
+    db = flaskDb.database
+    total = 0
+    for chunk in chunks:
+        where = (Account.username << chunk) & condition
+        with db.atomic():
+            # Number the affected rows with a reserved block of the change
+            # sequence right inside the statement.
+            db.execute_sql('SET @change_seq = %s', (next_change_seq(len(chunk)) - 1,))
+            if fields is None:
+                # Leave tombstones so /changes reports the deletions
+                DeletedAccount.insert_from(
+                    [DeletedAccount.username, DeletedAccount.system_id, DeletedAccount.deleted,
+                     DeletedAccount.change_seq],
+                    Account.select(Account.username, Account.system_id, SQL('NOW()'),
+                                   SQL('(@change_seq := @change_seq + 1)')).where(where)).execute()
+                num = Account.delete().where(where).execute()
+            else:
+                update = {getattr(Account, name): v for name, v in fields.items()}
+                update[Account.last_modified] = datetime.now()
+                update[Account.change_seq] = SQL('(@change_seq := @change_seq + 1)')
+                num = Account.update(update).where(where).execute()
+            new_bulk_event(operation, description.format(value, num))
+        total += num
+    return total
+
+
+def username_chunks(usernames):
+    chunk_size = cfg_get('bulk_chunk_size')
+    for i in range(0, len(usernames), chunk_size):
+        yield usernames[i:i + chunk_size]
+
+
+def filtered_username_chunks(condition):
+    # Walks matching accounts in username order, seeking past the last chunk
+    # instead of using OFFSET.
+    chunk_size = cfg_get('bulk_chunk_size')
+    last_username = None
+    while True:
+        query = Account.select(Account.username).where(condition)
+        if last_username is not None:
+            query = query.where(Account.username > last_username)
+        chunk = [acc.username for acc in query.order_by(Account.username).limit(chunk_size)]
+        if not chunk:
+            break
+        yield chunk
+        last_username = chunk[-1]
+
+
+def new_bulk_event(operation, description):
+    evt = Event(entity_type='bulk', entity_id=operation, description=description)
+    evt.save()
+    log.info("Bulk operation {}: {}".format(operation, description))
+    publish({
+        'id': evt.id,
+        'timestamp': time.mktime(evt.timestamp.timetuple()),
+        'type': 'bulk',
+        'username': None,
+        'system_id': None,
+        'description': description
+    })
+
+
 def create_tables(db):
     db.connect()
 
-    tables = [Account, Event, Version]
+    tables = [Account, Event, Version, ChangeCounter, DeletedAccount]
     for table in tables:
         if not table.table_exists():
             log.info('Creating table: %s', table.__name__)
@@ -11,6 +11,18 @@ def parse_bool(val):
     return False
 
 
+def load_usernames(lines):
+    # Accepts plain username lists as well as account CSV files.
+    usernames = []
+    for line in lines:
+        username = line.replace(':', ',').split(',')
+        username = username[1] if len(username) == 3 else username[0]
+        username = username.strip()
+        if username:
+            usernames.append(username)
+    return usernames
+
+
 def rss_mem_size():
     process = psutil.Process(os.getpid())
     mem = process.memory_info().rss
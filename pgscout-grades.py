@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import json
+import logging
+import sys
+import time
+
+import configargparse
+import requests
+from bs4 import BeautifulSoup
+
+from pgscout.moveset_grades import read_grade_table, write_grade_table
+
+logging.basicConfig(level=logging.INFO,
+    format='%(asctime)s [%(threadName)16s][%(module)14s][%(levelname)8s] %(message)s')
+log = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = configargparse.ArgParser(
+        description='Builds the moveset grade table PGScout loads at startup.')
+    parser.add_argument('-o', '--output', default='moveset_grades.json',
+                        help='Grade table file to write. Existing grades in it are kept.')
+    parser.add_argument('-p', '--pokemon', type=int, action='append', default=[],
+                        help='Only fetch grades for this Pokemon ID. Can be given multiple times.')
+    parser.add_argument('-r', '--refresh', action='store_true', default=False,
+                        help='Fetch grades again for Pokemon already in the table.')
+    parser.add_argument('-d', '--delay', type=float, default=1.0,
+                        help='Seconds to wait between two page requests.')
+    parser.add_argument('-l', '--legacy-file',
+                        help='Convert an old name-keyed pokemon_moveset_grades.json instead of fetching grades.')
+    return parser.parse_args()
+
+
+def load_json(filename):
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def scrape_movesets(pokemon_id):
+    # Returns a dict mapping "quick move / charge move" names to grades.
+    movesets = {}
+    r = requests.get('https://pokemongo.gamepress.gg/pokemon/{}'.format(pokemon_id), timeout=30)
+    soup = BeautifulSoup(r.text, "html.parser")
+
+    result = soup.find('div', 'view-moveset').div.table.tbody
+    for row in result.find_all('tr'):
+        qm_td = row.find('td', 'views-field-field-quick-move')
+        qm = qm_td.article.h2.a.span.text
+
+        cm_td = row.find('td', 'views-field-field-charge-move')
+        cm = cm_td.article.h2.a.span.text
+
+        off_grade_td = row.find('td', 'views-field-field-offensive-moveset-grade')
+        off_grade = off_grade_td.div.text
+
+        def_grade_td = row.find('td', 'views-field-field-defensive-moveset-grade')
+        def_grade = def_grade_td.div.text
+
+        moveset_key = u"{} / {}".format(qm, cm)
+        movesets[moveset_key] = {
+            'offense': off_grade.strip(),
+            'defense': def_grade.strip()
+        }
+    return movesets
+
+
+def add_movesets(table, pokemon_id, movesets, move_ids):
+    for moveset_key, grades in movesets.iteritems():
+        qm, cm = moveset_key.split(' / ', 1)
+        if qm not in move_ids or cm not in move_ids:
+            log.warning(u"Unknown moves in moveset {} of Pokemon {}.".format(moveset_key, pokemon_id))
+            continue
+        table[(pokemon_id, move_ids[qm], move_ids[cm])] = (grades['offense'], grades['defense'])
+
+
+# ---------------------------------------------------------------------------
+
+args = parse_args()
+
+pokemon_names = load_json('pokemon.json')
+move_ids = dict((name, int(move_id)) for move_id, name in load_json('pokemon_moves.json').iteritems())
+
+try:
+    table = read_grade_table(args.output)
+    log.info("Read {} moveset grades from {}.".format(len(table), args.output))
+except IOError:
+    table = {}
+
+if args.legacy_file:
+    pokemon_ids = dict((name, int(pokemon_id)) for pokemon_id, name in pokemon_names.iteritems())
+    for name, movesets in load_json(args.legacy_file).iteritems():
+        if name not in pokemon_ids:
+            log.warning(u"Unknown Pokemon {} in {}.".format(name, args.legacy_file))
+            continue
+        add_movesets(table, pokemon_ids[name], movesets, move_ids)
+else:
+    known = set(key[0] for key in table)
+    wanted = args.pokemon or sorted(int(pokemon_id) for pokemon_id in pokemon_names)
+    for pokemon_id in wanted:
+        if pokemon_id in known and not args.refresh:
+            continue
+        try:
+            movesets = scrape_movesets(pokemon_id)
+        except Exception as e:
+            log.error("Could not fetch movesets of Pokemon {}: {}".format(pokemon_id, repr(e)))
+            continue
+        log.info(u"Fetched {} movesets of {}.".format(len(movesets), pokemon_names.get(str(pokemon_id))))
+        add_movesets(table, pokemon_id, movesets, move_ids)
+        time.sleep(args.delay)
+
+write_grade_table(args.output, table)
+log.info("Wrote {} moveset grades to {}.".format(len(table), args.output))
+sys.exit(0)
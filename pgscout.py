@@ -1,19 +1,33 @@
+import json
 import logging
+import math
 import sys
 import time
 import signal
-from Queue import Queue
+from Queue import Queue, Empty
 from threading import Thread
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 
+from pgscout.JobDispatcher import JobDispatcher
+from pgscout.autoscaler import autoscaler_thread
 from pgscout.ScoutGuard import ScoutGuard
 from pgscout.ScoutJob import ScoutJob
-from pgscout.cache import get_cached_encounter, cache_encounter, cleanup_cache
-from pgscout.config import cfg_get, cfg_init
+from pgscout.cache import get_cached_encounter, cache_encounter, cleanup_cache, \
+    init_cache
+from pgscout.config import cfg_get, cfg_init, use_pgpool
 from pgscout.console import print_status
-from pgscout.utils import get_pokemon_name, normalize_encounter_id, \
-    load_pgpool_accounts, app_state
+from pgscout.gmo_cache import cleanup_gmo_cache
+from pgscout.inflight import submit_job, is_inflight
+from pgscout.jobstore import store_job, get_stored_job, cleanup_jobs
+from pgscout.metrics import render_metrics
+from pgscout.moveset_grades import load_moveset_grades, moveset_grades_reloader
+from pgscout.proxy import proxy_revalidator
+from pgscout.standby import standby_refiller
+from pgscout.startup import start_eager_login, get_login_state
+from pgscout.utils import normalize_encounter_id, \
+    load_pgpool_accounts, app_state, parse_despawn_time, estimate_queue_wait
+from pgscout.webhook import send_webhook, webhook_sender
 
 logging.basicConfig(level=logging.INFO,
     format='%(asctime)s [%(threadName)16s][%(module)14s][%(levelname)8s] %(message)s')
@@ -27,11 +41,33 @@ logging.getLogger('werkzeug').setLevel(logging.ERROR)
 app = Flask(__name__)
 
 scouts = []
-jobs = Queue()
+jobs = JobDispatcher()
 
 # ===========================================================================
 
 
+@app.route("/health", methods=['GET'])
+def get_health():
+    state = get_login_state()
+    response = jsonify({
+        'ready': not state['starting'],
+        'accepting_requests': app_state.accept_new_requests,
+        'scouts': len(scouts),
+        'scouts_active': len([s for s in scouts if s.active]),
+        'scouts_logged_in': state['ready'],
+        'scouts_login_failed': state['failed'],
+        'queue_length': jobs.qsize()
+    })
+    if state['starting']:
+        response.status_code = 503
+    return response
+
+
+@app.route("/metrics", methods=['GET'])
+def get_metrics():
+    return Response(render_metrics(scouts, jobs), mimetype='text/plain; version=0.0.4')
+
+
 @app.route("/iv", methods=['GET'])
 def get_iv():
     if not app_state.accept_new_requests:
@@ -40,37 +76,238 @@ def get_iv():
             'error': 'Not accepting new requests.'
         })
 
-    pokemon_id = request.args["pokemon_id"]
-    pokemon_name = get_pokemon_name(pokemon_id)
-    lat = request.args["latitude"]
-    lng = request.args["longitude"]
-
-    encounter_id = normalize_encounter_id(request.args.get("encounter_id"))
-    # Spawn point ID is assumed to be a hex string
-    spawn_point_id = request.args.get("spawn_point_id")
+    try:
+        cache_key, job = create_job(request.args)
+    except (ValueError, TypeError) as e:
+        response = jsonify({
+            'success': False,
+            'error': 'Invalid job: {}'.format(repr(e))
+        })
+        response.status_code = 400
+        return response
 
     # Check cache
-    cache_key = encounter_id if encounter_id else "{}-{}-{}".format(pokemon_id, lat, lng)
-    result = get_cached_encounter(cache_key)
+    result = get_cached_result(cache_key, job)
     if result:
-        log.info(
-            u"Returning cached result: {:.1f}% level {} {} with {} CP".format(result['iv_percent'], result['level'], pokemon_name, result['cp']))
+        log_cached_result(result, job)
         return jsonify(result)
 
-    # Create a ScoutJob
-    job = ScoutJob(pokemon_id, encounter_id, spawn_point_id, lat, lng)
+    # Jobs already running don't add any load
+    if not is_inflight(cache_key):
+        retry_after = check_admission()
+        if retry_after:
+            log.warning(u"Rejecting {} at {}, {}: queue too long.".format(job.pokemon_name, job.lat, job.lng))
+            return reject_overloaded(retry_after)
 
-    # Enqueue and wait for job to be processed
-    jobs.put(job)
-    while not job.processed:
-        time.sleep(1)
+    # Enqueue the ScoutJob or attach to a running one for the same encounter
+    job = submit_iv_job(cache_key, job)
+
+    # Wait for job to be processed
+    if not job.wait(cfg_get('iv_timeout')):
+        log.warning(u"Timed out waiting for result of {} at {}, {}.".format(job.pokemon_name, job.lat, job.lng))
+        return jsonify(timeout_error())
 
-    # Cache successful jobs and return result
-    if job.result['success']:
-        cache_encounter(cache_key, job.result)
     return jsonify(job.result)
 
 
+@app.route("/iv/batch", methods=['POST'])
+def get_iv_batch():
+    if not app_state.accept_new_requests:
+        return jsonify({
+            'success': False,
+            'error': 'Not accepting new requests.'
+        })
+
+    specs = json.loads(request.data)
+    # Lines that can be sent right away and jobs still running, by index
+    ready = []
+    running = {}
+    results = Queue()
+    for index, spec in enumerate(specs):
+        try:
+            cache_key, job = create_job(spec)
+        except (KeyError, ValueError, TypeError) as e:
+            ready.append(dict(index=index, success=False, error='Invalid job: {}'.format(repr(e))))
+            continue
+
+        result = get_cached_result(cache_key, job)
+        if result:
+            log_cached_result(result, job)
+            ready.append(dict(result, index=index))
+            continue
+
+        if not is_inflight(cache_key):
+            retry_after = check_admission()
+            if retry_after:
+                ready.append(dict(index=index, success=False, retry_after=retry_after,
+                                  error='Too many queued jobs. Retry after {} seconds.'.format(retry_after)))
+                continue
+
+        job = submit_iv_job(cache_key, job)
+        running[index] = job
+        job.add_done_callback(lambda j, index=index: results.put((index, j.result)))
+
+    log.info("Batch request with {} jobs: {} answered right away, {} scouting.".format(
+        len(specs), len(ready), len(running)))
+
+    def generate():
+        for line in ready:
+            yield json.dumps(line) + '\n'
+        # Stream results in the order they complete
+        deadline = time.time() + cfg_get('iv_timeout')
+        while running:
+            try:
+                index, result = results.get(timeout=max(0, deadline - time.time()))
+            except Empty:
+                break
+            del running[index]
+            yield json.dumps(dict(result, index=index)) + '\n'
+        for index in sorted(running.keys()):
+            yield json.dumps(dict(timeout_error(), index=index)) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@app.route("/jobs", methods=['POST'])
+def post_jobs():
+    if not app_state.accept_new_requests:
+        return jsonify({
+            'success': False,
+            'error': 'Not accepting new requests.'
+        })
+
+    specs = json.loads(request.data)
+    single = isinstance(specs, dict)
+    if single:
+        specs = [specs]
+
+    submitted = []
+    for spec in specs:
+        try:
+            cache_key, job = create_job(spec)
+        except (KeyError, ValueError, TypeError) as e:
+            submitted.append({'success': False, 'error': 'Invalid job: {}'.format(repr(e))})
+            continue
+
+        result = get_cached_result(cache_key, job)
+        if result:
+            # Answer from cache but still deliver like any other job
+            job.result = result
+            job.set_processed()
+        else:
+            if not is_inflight(cache_key):
+                retry_after = check_admission()
+                if retry_after:
+                    if single:
+                        return reject_overloaded(retry_after)
+                    submitted.append({'success': False, 'retry_after': retry_after,
+                                      'error': 'Too many queued jobs. Retry after {} seconds.'.format(retry_after)})
+                    continue
+            job = submit_iv_job(cache_key, job)
+
+        store_job(job)
+        if cfg_get('webhook_url') and not job.webhook:
+            job.webhook = True
+            job.add_done_callback(send_webhook)
+        submitted.append(job_status(job))
+
+    return jsonify(submitted[0] if single else submitted)
+
+
+@app.route("/jobs/<job_id>", methods=['GET'])
+def get_job(job_id):
+    job = get_stored_job(job_id)
+    if not job:
+        return jsonify({
+            'success': False,
+            'error': 'Unknown job ID.'
+        }), 404
+    return jsonify(job_status(job))
+
+
+def job_status(job):
+    status = {
+        'success': True,
+        'job_id': job.id,
+        'status': 'done' if job.processed else 'pending'
+    }
+    if job.processed:
+        status['result'] = job.result
+    return status
+
+
+def create_job(args):
+    # Builds a ScoutJob and its cache key from request parameters.
+    pokemon_id = args["pokemon_id"]
+    lat = args["latitude"]
+    lng = args["longitude"]
+
+    encounter_id = normalize_encounter_id(args.get("encounter_id"))
+    # Spawn point ID is assumed to be a hex string
+    spawn_point_id = args.get("spawn_point_id")
+    despawn_time = parse_despawn_time(args.get("despawn_time"))
+    priority = args.get("priority")
+    priority = int(priority) if priority is not None else None
+
+    cache_key = encounter_id if encounter_id else "{}-{}-{}".format(pokemon_id, lat, lng)
+    job = ScoutJob(pokemon_id, encounter_id, spawn_point_id, lat, lng, despawn_time, priority)
+    return cache_key, job
+
+
+def submit_iv_job(cache_key, job):
+    job.add_done_callback(lambda j: cache_job_result(cache_key, j))
+    return submit_job(cache_key, job, jobs)
+
+
+def log_cached_result(result, job):
+    if result['success']:
+        log.info(
+            u"Returning cached result: {:.1f}% level {} {} with {} CP".format(result['iv_percent'], result['level'], job.pokemon_name, result['cp']))
+    else:
+        log.info(u"Returning cached error for {}: {}".format(job.pokemon_name, result['error']))
+
+
+def timeout_error():
+    return {
+        'success': False,
+        'error': 'Timed out after {} seconds waiting for a scout.'.format(cfg_get('iv_timeout'))
+    }
+
+
+def check_admission():
+    # Returns number of seconds the client should wait if the estimated queue
+    # wait exceeds the configured budget, otherwise None.
+    max_wait = cfg_get('max_queue_wait')
+    if not max_wait:
+        return None
+    wait = estimate_queue_wait(scouts, jobs)
+    if wait is None or wait <= max_wait:
+        return None
+    return max(1, int(math.ceil(wait - max_wait)))
+
+
+def reject_overloaded(retry_after):
+    response = jsonify({
+        'success': False,
+        'error': 'Too many queued jobs. Retry after {} seconds.'.format(retry_after),
+        'retry_after': retry_after
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def get_cached_result(cache_key, job):
+    # Jobs without encounter ID may also match results close by.
+    if job.encounter_id:
+        return get_cached_encounter(cache_key)
+    return get_cached_encounter(cache_key, job.pokemon_id, job.lat, job.lng)
+
+
+def cache_job_result(cache_key, job):
+    cache_encounter(cache_key, job.result, job.pokemon_id, job.lat, job.lng)
+
+
 def run_webserver():
     app.run(threaded=True, host=cfg_get('host'), port=cfg_get('port'))
 
@@ -80,6 +317,16 @@ def cache_cleanup_thread():
         time.sleep(60)
         num_deleted = cleanup_cache()
         log.info("Cleaned up {} entries from encounter cache.".format(num_deleted))
+        num_deleted = cleanup_jobs()
+        log.info("Cleaned up {} finished jobs.".format(num_deleted))
+        num_deleted = cleanup_gmo_cache()
+        log.info("Cleaned up {} wild Pokemon from GMO cache.".format(num_deleted))
+
+
+def job_expiry_thread():
+    while True:
+        time.sleep(1)
+        jobs.expire_jobs()
 
 
 def load_accounts(jobs):
@@ -119,18 +366,62 @@ def signal_handler(signal, frame):
 log.info("PGScout starting up.")
 
 cfg_init()
+init_cache()
+load_moveset_grades(cfg_get('moveset_grades_file'))
 
 scouts = load_accounts(jobs)
-for scout in scouts:
-    t = Thread(target=scout.run)
-    t.daemon = True
-    t.start()
+if cfg_get('eager_login'):
+    start_eager_login(scouts)
+else:
+    for scout in scouts:
+        t = Thread(target=scout.run)
+        t.daemon = True
+        t.start()
 
 # Cleanup cache in background
 t = Thread(target=cache_cleanup_thread, name="cache_cleaner")
 t.daemon = True
 t.start()
 
+# Fail queued jobs that cannot be scouted before their Pokemon despawns
+t = Thread(target=job_expiry_thread, name="job_expiry")
+t.daemon = True
+t.start()
+
+# Keep the list of working proxies up to date
+if cfg_get('proxies') and cfg_get('proxy_check_interval') > 0:
+    t = Thread(target=proxy_revalidator, name="proxy_checker",
+               args=(cfg_get('proxy_provider'), cfg_get('proxies_file'), cfg_get('proxy_check_interval'),
+                     cfg_get('proxy_test_url'), cfg_get('proxy_check_timeout'), cfg_get('proxy_check_retries'),
+                     cfg_get('proxy_check_threads')))
+    t.daemon = True
+    t.start()
+
+# Keep accounts ready to replace banned ones
+if cfg_get('standby_accounts') > 0 and use_pgpool():
+    t = Thread(target=standby_refiller, name="standby_refiller", args=(scouts, jobs))
+    t.daemon = True
+    t.start()
+
+# Follow the load with the number of PGPool accounts
+if cfg_get('autoscale_max') > 0 and use_pgpool():
+    t = Thread(target=autoscaler_thread, name="autoscaler", args=(scouts, jobs))
+    t.daemon = True
+    t.start()
+
+# Pick up rebuilt moveset grade tables
+if cfg_get('moveset_grades_reload') > 0:
+    t = Thread(target=moveset_grades_reloader, name="grades_reloader",
+               args=(cfg_get('moveset_grades_file'), cfg_get('moveset_grades_reload')))
+    t.daemon = True
+    t.start()
+
+# Deliver results of asynchronous jobs
+if cfg_get('webhook_url'):
+    t = Thread(target=webhook_sender, name="webhook_sender")
+    t.daemon = True
+    t.start()
+
 # Start thread to print current status and get user input.
 t = Thread(target=print_status,
            name='status_printer', args=(scouts, cfg_get('initial_view'), jobs))
@@ -0,0 +1,103 @@
+import logging
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+# Hash key quotas are counted per minute
+WINDOW = 60.0
+
+
+class HashKey(object):
+    def __init__(self, key, rpm):
+        self.key = key
+        self.rpm = rpm
+        # Timestamps of requests within the last minute
+        self.requests = deque()
+        self.backoff_until = 0
+        self.quota_errors = 0
+
+    def prune(self, now):
+        while self.requests and self.requests[0] <= now - WINDOW:
+            self.requests.popleft()
+
+    def utilization(self):
+        return len(self.requests) / float(self.rpm)
+
+
+class HashKeyScheduler(object):
+    # Drop-in replacement for a CyclicResourceProvider of hash keys. Hands
+    # out the least loaded key that has quota left in the current minute and
+    # skips keys that recently ran out of quota. Blocks if all keys are used
+    # up instead of causing quota errors.
+
+    def __init__(self, default_rpm, backoff):
+        self.keys = []
+        self.default_rpm = default_rpm
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        # Remembers the key each thread used last to attribute quota errors
+        self.last_key = threading.local()
+
+    def add_resource(self, resource):
+        # Accepts "key" or "key:rpm".
+        key, _, rpm = resource.partition(':')
+        self.keys.append(HashKey(key.strip(), int(rpm) if rpm else self.default_rpm))
+
+    def len(self):
+        return len(self.keys)
+
+    def next(self):
+        while True:
+            now = time.time()
+            with self.lock:
+                best = None
+                wait = None
+                for hk in self.keys:
+                    hk.prune(now)
+                    if hk.backoff_until > now:
+                        free_at = hk.backoff_until
+                    elif len(hk.requests) >= hk.rpm:
+                        free_at = hk.requests[0] + WINDOW
+                    else:
+                        if best is None or hk.utilization() < best.utilization():
+                            best = hk
+                        continue
+                    wait = free_at - now if wait is None else min(wait, free_at - now)
+                if best is not None:
+                    best.requests.append(now)
+                    self.last_key.key = best
+                    return best.key
+            log.warning("All hash keys used up, waiting {:.1f}s.".format(wait))
+            time.sleep(wait)
+
+    def report_quota_exceeded(self):
+        # Backs off the key the calling thread used last.
+        hk = getattr(self.last_key, 'key', None)
+        if hk is None:
+            return
+        with self.lock:
+            hk.quota_errors += 1
+            hk.backoff_until = time.time() + self.backoff
+        log.warning("Hash key {} exceeded its quota. Not using it for {}s.".format(mask_key(hk.key), self.backoff))
+
+    def get_stats(self):
+        now = time.time()
+        stats = []
+        with self.lock:
+            for hk in self.keys:
+                hk.prune(now)
+                stats.append({
+                    'key': mask_key(hk.key),
+                    'rpm': hk.rpm,
+                    'used': len(hk.requests),
+                    'utilization': hk.utilization(),
+                    'backed_off': hk.backoff_until > now,
+                    'quota_errors': hk.quota_errors
+                })
+        return stats
+
+
+def mask_key(key):
+    return key[:4] + '...' if len(key) > 4 else key
@@ -0,0 +1,272 @@
+import itertools
+import logging
+import time
+from heapq import heappush, heappop
+from threading import Lock, Event
+
+from pgscout.config import cfg_get
+from pgscout.utils import get_distance, grid_cell, cell_width
+
+log = logging.getLogger(__name__)
+
+# Size of the grid cells idle scouts are indexed by, in degrees (~5.5km)
+CELL_SIZE = 0.05
+
+# Search this many rings of cells around a job before checking every idle
+# scout instead.
+MAX_RINGS = 20
+
+
+class IdleScout(object):
+    def __init__(self, scout, position):
+        self.scout = scout
+        self.position = position
+        self.cell = grid_cell(position[0], position[1], CELL_SIZE) if position else None
+        self.job = None
+        self.event = Event()
+        # Whether the scout is still waiting in the idle index
+        self.registered = False
+
+
+class JobDispatcher(object):
+    # Replacement for a plain job queue. A new job goes to the nearest idle
+    # scout to keep teleports short. If no scout is idle jobs wait and the
+    # next scout that gets free takes the one with highest priority, earliest
+    # despawn time and then the oldest one. Jobs that cannot be scouted before
+    # their Pokemon despawns get failed right away. Jobs that need a GMO only
+    # go to scouts that may send one right now.
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counter = itertools.count()
+        # Heap of (-priority, despawn_time, seq, job)
+        self.pending = []
+        # Heap of (despawn_time, seq, job) for jobs with a despawn time
+        self.deadlines = []
+        # Sequence numbers of jobs still waiting, heap items of other ones
+        # are outdated and skipped.
+        self.waiting = set()
+        self.num_expired = 0
+
+        # Idle scouts by grid cell. Scouts without a position yet are kept
+        # separately, they get jobs first since they cannot teleport.
+        self.idle_cells = {}
+        self.idle_unpositioned = []
+        self.num_idle_positioned = 0
+
+        # Jump distance statistics
+        self.total_distance = 0.0
+        self.num_jumps = 0
+
+    def qsize(self):
+        return len(self.waiting)
+
+    def idle_count(self):
+        return self.num_idle_positioned + len(self.idle_unpositioned)
+
+    def average_jump_distance(self):
+        return self.total_distance / self.num_jumps if self.num_jumps else 0.0
+
+    def put(self, job):
+        if self.is_expired(job, time.time()):
+            self.fail_expired([job])
+            return
+        with self.lock:
+            idle = self.take_nearest_idle(job)
+            if idle is None:
+                seq = next(self.counter)
+                despawn_time = job.despawn_time or float('inf')
+                heappush(self.pending, (-job.priority, despawn_time, seq, job))
+                if job.despawn_time:
+                    heappush(self.deadlines, (job.despawn_time, seq, job))
+                self.waiting.add(seq)
+                return
+            self.record_jump(idle.position, job)
+        idle.job = job
+        idle.event.set()
+
+    def get(self, scout):
+        # Blocks until there is a job for the given scout. Returns None if
+        # the scout got retired.
+        position = scout.last_position
+        while True:
+            gmo_wait = scout.gmo_tokens.wait_time()
+            job = None
+            skipped = []
+            with self.lock:
+                expired = self.take_expired()
+                while self.pending:
+                    item = heappop(self.pending)
+                    _, _, seq, job = item
+                    if seq not in self.waiting:
+                        job = None
+                        continue
+                    if gmo_wait and needs_gmo(job):
+                        # Leave it for a scout that has a GMO token
+                        skipped.append(item)
+                        job = None
+                        continue
+                    self.waiting.remove(seq)
+                    self.record_jump(position, job)
+                    break
+                for item in skipped:
+                    heappush(self.pending, item)
+                if job is None:
+                    idle = IdleScout(scout, position)
+                    self.add_idle(idle)
+            self.fail_expired(expired)
+            if job is not None:
+                return job
+
+            # Look at the jobs needing a GMO again once there is a token
+            if idle.event.wait(gmo_wait or None):
+                return idle.job
+            with self.lock:
+                if idle.registered:
+                    self.remove_idle(idle)
+                    continue
+            # Got a job or retired right after the timeout
+            idle.event.wait()
+            return idle.job
+
+    def retire_idle(self):
+        # Wakes an idle scout without a job so it stops. Prefers scouts that
+        # never got a job. Returns the scout or None if none is idle.
+        with self.lock:
+            if self.idle_unpositioned:
+                idle = self.idle_unpositioned[0]
+            elif self.num_idle_positioned:
+                idle = next(self.idle_cells.itervalues())[0]
+            else:
+                return None
+            self.remove_idle(idle)
+        idle.job = None
+        idle.event.set()
+        return idle.scout
+
+    def expire_jobs(self):
+        # Fails waiting jobs that cannot be scouted in time anymore.
+        with self.lock:
+            expired = self.take_expired()
+        self.fail_expired(expired)
+
+    def is_expired(self, job, now):
+        return job.despawn_time and job.despawn_time - cfg_get('job_min_time') < now
+
+    def take_expired(self):
+        now = time.time()
+        expired = []
+        while self.deadlines and self.is_expired(self.deadlines[0][2], now):
+            _, seq, job = heappop(self.deadlines)
+            if seq in self.waiting:
+                self.waiting.remove(seq)
+                expired.append(job)
+        return expired
+
+    def fail_expired(self, expired):
+        for job in expired:
+            self.num_expired += 1
+            log.info(u"Dropping job for {} at {}, {}: despawns before it can be scouted.".format(
+                job.pokemon_name, job.lat, job.lng))
+            job.result = {
+                'success': False,
+                'error': 'DESPAWNS_BEFORE_SCOUTED'
+            }
+            job.set_processed()
+
+    def record_jump(self, position, job):
+        if position:
+            self.total_distance += get_distance(position[0], position[1], job.lat, job.lng)
+            self.num_jumps += 1
+
+    def add_idle(self, idle):
+        idle.registered = True
+        if idle.cell is None:
+            self.idle_unpositioned.append(idle)
+        else:
+            self.idle_cells.setdefault(idle.cell, []).append(idle)
+            self.num_idle_positioned += 1
+
+    def remove_idle(self, idle):
+        idle.registered = False
+        if idle.cell is None:
+            self.idle_unpositioned.remove(idle)
+        else:
+            cell = self.idle_cells[idle.cell]
+            cell.remove(idle)
+            if not cell:
+                del self.idle_cells[idle.cell]
+            self.num_idle_positioned -= 1
+
+    def take_nearest_idle(self, job):
+        gmo = needs_gmo(job)
+        idle = None
+        for candidate in self.idle_unpositioned:
+            if not gmo or can_gmo(candidate.scout):
+                idle = candidate
+                break
+        if idle is None and self.num_idle_positioned:
+            idle = self.find_nearest_idle(job.lat, job.lng, gmo)
+        if idle is None:
+            return None
+        self.remove_idle(idle)
+        return idle
+
+    def find_nearest_idle(self, lat, lng, gmo):
+        # Search the grid in growing rings of cells around the job until no
+        # closer scout can be found in the next ring.
+        cx, cy = grid_cell(lat, lng, CELL_SIZE)
+        # Shortest distance from the job to a cell of ring r is at least
+        # (r - 1) cells wide.
+        cell_m = cell_width(lat, CELL_SIZE)
+
+        best = None
+        best_distance = None
+        seen = 0
+        for r in range(MAX_RINGS + 1):
+            if best is not None and (r - 1) * cell_m > best_distance:
+                return best
+            for cell in ring_cells(cx, cy, r):
+                for idle in self.idle_cells.get(cell, []):
+                    seen += 1
+                    if gmo and not can_gmo(idle.scout):
+                        continue
+                    d = get_distance(lat, lng, idle.position[0], idle.position[1])
+                    if best is None or d < best_distance:
+                        best = idle
+                        best_distance = d
+            if seen == self.num_idle_positioned:
+                return best
+
+        # Remaining scouts are far away, just check all of them.
+        for cell in self.idle_cells.itervalues():
+            for idle in cell:
+                if gmo and not can_gmo(idle.scout):
+                    continue
+                d = get_distance(lat, lng, idle.position[0], idle.position[1])
+                if best is None or d < best_distance:
+                    best = idle
+                    best_distance = d
+        return best
+
+
+def needs_gmo(job):
+    # Without encounter details the scout has to look for the Pokemon, unless
+    # a recent GMO already saw it.
+    return not (job.encounter_id and job.spawn_point_id)
+
+
+def can_gmo(scout):
+    return not scout.gmo_tokens.wait_time()
+
+
+def ring_cells(cx, cy, r):
+    if r == 0:
+        yield cx, cy
+        return
+    for x in range(cx - r, cx + r + 1):
+        yield x, cy - r
+        yield x, cy + r
+    for y in range(cy - r + 1, cy + r):
+        yield cx - r, y
+        yield cx + r, y
@@ -0,0 +1,153 @@
+import logging
+import random
+import time
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+# Weight of a new sample in the moving averages of latency and errors
+EWMA_ALPHA = 0.2
+
+
+class ProxyStats(object):
+    def __init__(self, latency=None):
+        self.latency = latency or 1.0
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.ejected_until = 0
+
+    def is_ejected(self, now):
+        return self.ejected_until > now
+
+
+class ProxyManager(object):
+    # Hands out working proxies weighted by their measured latency, error
+    # rate and number of accounts using them. Proxies that keep failing are
+    # ejected for a while. Accounts keep their proxy as long as it is fine.
+    # The set of proxies can be replaced while scouts are running.
+
+    def __init__(self, eject_failures=5, eject_time=300):
+        self.proxies = []
+        self.stats = {}
+        # Maps username to proxy
+        self.assignments = {}
+        # Number of accounts assigned to each proxy
+        self.users = {}
+        self.eject_failures = eject_failures
+        self.eject_time = eject_time
+        self.lock = Lock()
+
+    def add_resource(self, proxy):
+        with self.lock:
+            self.proxies.append(proxy)
+            self.stats.setdefault(proxy, ProxyStats())
+
+    def len(self):
+        return len(self.proxies)
+
+    def next(self, username=None):
+        with self.lock:
+            if not self.proxies:
+                return None
+            now = time.time()
+            proxy = self.assignments.get(username)
+            if proxy not in self.proxies or self.stats[proxy].is_ejected(now):
+                proxy = self.pick(now)
+                if username:
+                    self.unassign(username)
+                    self.assignments[username] = proxy
+                    self.users[proxy] = self.users.get(proxy, 0) + 1
+            return proxy
+
+    def release(self, username):
+        # Forgets the proxy of an account that is not used anymore.
+        with self.lock:
+            self.unassign(username)
+
+    def unassign(self, username):
+        proxy = self.assignments.pop(username, None)
+        if proxy is not None:
+            self.users[proxy] -= 1
+            if not self.users[proxy]:
+                del self.users[proxy]
+
+    def for_account(self, username):
+        # Provider for a single account that sticks to its proxy.
+        return AccountProxyProvider(self, username)
+
+    def pick(self, now):
+        candidates = [p for p in self.proxies if not self.stats[p].is_ejected(now)]
+        if not candidates:
+            # Better a bad proxy than none at all
+            candidates = self.proxies
+        weights = [self.weight(p, self.users.get(p, 0)) for p in candidates]
+        r = random.uniform(0, sum(weights))
+        for proxy, weight in zip(candidates, weights):
+            r -= weight
+            if r <= 0:
+                return proxy
+        return candidates[-1]
+
+    def weight(self, proxy, num_users):
+        stats = self.stats[proxy]
+        return 1.0 / (stats.latency * (1 + 4 * stats.error_rate) ** 2 * (1 + num_users))
+
+    def record_request(self, proxy, latency, success, banned=False):
+        with self.lock:
+            stats = self.stats.get(proxy)
+            if stats is None:
+                return
+            stats.requests += 1
+            stats.error_rate = (1 - EWMA_ALPHA) * stats.error_rate + EWMA_ALPHA * (0 if success else 1)
+            if success:
+                stats.latency = (1 - EWMA_ALPHA) * stats.latency + EWMA_ALPHA * latency
+                stats.consecutive_errors = 0
+                return
+            stats.errors += 1
+            stats.consecutive_errors += 1
+            if banned or stats.consecutive_errors >= self.eject_failures:
+                stats.ejected_until = time.time() + self.eject_time
+                stats.consecutive_errors = 0
+                log.warning("Proxy {} {}. Not using it for {}s.".format(
+                    proxy, 'got banned' if banned else 'keeps failing', self.eject_time))
+
+    def set_proxies(self, proxies, latencies):
+        with self.lock:
+            added = len(set(proxies) - set(self.proxies))
+            removed = len(set(self.proxies) - set(proxies))
+            self.proxies = list(proxies)
+            for proxy in proxies:
+                if proxy in self.stats:
+                    # Passing the check gives an ejected proxy another chance
+                    self.stats[proxy].ejected_until = 0
+                else:
+                    self.stats[proxy] = ProxyStats(latencies.get(proxy))
+        if added or removed:
+            log.info("Proxy list updated: {} added, {} removed, {} working.".format(added, removed, len(proxies)))
+
+    def health(self, proxy):
+        # Short description of the health of a proxy for the scouts view.
+        stats = self.stats.get(proxy)
+        if stats is None:
+            return '-'
+        if stats.is_ejected(time.time()):
+            return 'ejected'
+        if proxy not in self.proxies:
+            return 'removed'
+        return "{:.0f}ms {:.0f}%".format(stats.latency * 1000, stats.error_rate * 100)
+
+
+class AccountProxyProvider(object):
+    # What a single account sees as its proxy provider.
+
+    def __init__(self, manager, username):
+        self.manager = manager
+        self.username = username
+
+    def len(self):
+        return self.manager.len()
+
+    def next(self):
+        return self.manager.next(self.username)
@@ -7,10 +7,15 @@ import geopy
 from mrmime.pogoaccount import POGOAccount, CaptchaException
 from mrmime.shadowbans import COMMON_POKEMON
 from mrmime.utils import jitter_location
-from pgoapi.exceptions import AuthException, BannedAccountException
+from pgoapi.exceptions import AuthException, BannedAccountException, HashingQuotaExceededException, \
+    NianticIPBannedException
 from pgoapi.protos.pogoprotos.networking.responses.encounter_response_pb2 import *
 
+from pgscout.TokenBucket import TokenBucket
 from pgscout.config import cfg_get
+from pgscout.gmo_cache import index_wild_pokemon, lookup_wild_pokemon, forget_wild_pokemon, \
+    stale_sighting_errors
+from pgscout.metrics import StageTimer, observe_stage, count_encounter
 from pgscout.moveset_grades import get_moveset_grades
 from pgscout.stats import inc_for_pokemon
 from pgscout.utils import calc_pokemon_level, calc_iv
@@ -38,9 +43,11 @@ class Scout(POGOAccount):
     def __init__(self, auth, username, password, job_queue):
         super(Scout, self).__init__(auth, username, password,
                                     hash_key_provider=cfg_get('hash_key_provider'),
-                                    proxy_provider=cfg_get('proxy_provider'))
+                                    proxy_provider=cfg_get('proxy_provider').for_account(username))
 
         self.job_queue = job_queue
+        # Location of the last job, used to dispatch nearby jobs to this scout
+        self.last_position = None
 
         # Stats
         self.start_time = time.time()
@@ -54,16 +61,35 @@ class Scout(POGOAccount):
         # Number of errors that may be the cause of a shadowban
         self.errors = 0
 
+        # Pacing of requests of this account
+        self.encounter_tokens = TokenBucket(cfg_get('encounters_per_minute'), cfg_get('rate_burst'))
+        self.gmo_tokens = TokenBucket(cfg_get('gmos_per_minute'), cfg_get('rate_burst'))
+
+        # Set when the autoscaler stopped this scout
+        self.retired = False
+
     def run(self):
         self.log_info("Waiting for job...")
         while True:
-            job = self.job_queue.get()
+            # Only ask for a job when it can be encountered right away, so a
+            # scout being paced never holds back jobs others could do. The
+            # dispatcher only hands out jobs needing a GMO if it can send one.
+            self.encounter_tokens.wait()
+            job = self.job_queue.get(self)
+            if job is None:
+                self.log_info("Retired, not needed anymore.")
+                self.retired = True
+                break
+            observe_stage('queue_wait', time.time() - job.created)
             try:
                 self.log_info(u"Scouting a {} at {}, {}".format(job.pokemon_name, job.lat, job.lng))
                 # Initialize API
                 (lat, lng) = jitter_location(job.lat, job.lng)
                 self.set_position(lat, lng, job.altitude)
-                if not self.check_login():
+                self.last_position = (job.lat, job.lng)
+                with StageTimer('login'):
+                    logged_in = self.with_hash_retry(self.check_login)
+                if not logged_in:
                     job.result = self.scout_error(self.last_msg)
                     if self.is_banned() or self.has_captcha():
                         break
@@ -73,11 +99,19 @@ class Scout(POGOAccount):
                 if job.encounter_id and job.spawn_point_id:
                     job.result = self.scout_by_encounter_id(job)
                 else:
-                    if self.find_pokemon(job):
-                        time.sleep(2)
+                    if lookup_wild_pokemon(job):
+                        self.log_info("Got encounter_id for {} from recent GMO.".format(job.pokemon_name))
                         job.result = self.scout_by_encounter_id(job)
-                    else:
-                        job.result = self.scout_error("Could not determine encounter_id for {} at {}, {}".format(job.pokemon_name, job.lat, job.lng))
+                        if job.result.get('error') in stale_sighting_errors:
+                            # Pokemon is gone, look for another one
+                            forget_wild_pokemon(job)
+                            job.result = {}
+                    if not job.result:
+                        if self.find_pokemon(job):
+                            time.sleep(2)
+                            job.result = self.scout_by_encounter_id(job)
+                        elif not job.result:
+                            job.result = self.scout_error("Could not determine encounter_id for {} at {}, {}".format(job.pokemon_name, job.lat, job.lng))
 
                 # Mark shadowbanned if too many errors
                 sb_threshold = cfg_get('shadowban_threshold')
@@ -94,10 +128,48 @@ class Scout(POGOAccount):
             except Exception:
                 job.result = self.scout_error(repr(sys.exc_info()))
             finally:
-                job.processed = True
+                job.set_processed()
                 if self.is_banned() or self.has_captcha():
                     break
 
+    def with_hash_retry(self, request, *args):
+        # Retries a request with another hash key if the current one ran out
+        # of quota.
+        tries = 0
+        while True:
+            try:
+                return request(*args)
+            except HashingQuotaExceededException:
+                tries += 1
+                cfg_get('hash_key_provider').report_quota_exceeded()
+                if tries >= cfg_get('hash_key_provider').len():
+                    raise
+
+    def proxy_request(self, request, *args):
+        # Performs a request and records how the proxy of this account did.
+        start = time.time()
+        try:
+            response = self.with_hash_retry(request, *args)
+        except HashingQuotaExceededException:
+            raise
+        except NianticIPBannedException:
+            self.record_proxy(start, False, banned=True)
+            raise
+        except Exception:
+            self.record_proxy(start, False)
+            raise
+        self.record_proxy(start, bool(response))
+        return response
+
+    def record_proxy(self, start, success, banned=False):
+        if self.proxy_url:
+            cfg_get('proxy_provider').record_request(self.proxy_url, time.time() - start, success, banned)
+
+    def release_account(self, reason):
+        # Gives the account back to PGPool and frees its proxy.
+        self.update_pgpool(release=True, reason=reason)
+        cfg_get('proxy_provider').release(self.username)
+
     def update_history(self):
         if self.previous_encounter:
             # Determine current pause
@@ -128,9 +200,14 @@ class Scout(POGOAccount):
             tries += 1
             try:
                 self.log_info("Looking for {} at {}, {} - try {}".format(job.pokemon_name, job.lat, job.lng, tries))
+                if not self.gmo_tokens.try_consume():
+                    job.result = self.scout_error('GMO_RATE_LIMITED')
+                    return False
                 self.set_position(job.lat, job.lng, job.altitude)
-                response = self.req_get_map_objects()
+                with StageTimer('gmo'):
+                    response = self.proxy_request(self.req_get_map_objects)
                 wild_pokemon = self.parse_wild_pokemon(response)
+                index_wild_pokemon(wild_pokemon)
                 if len(wild_pokemon) > 0:
                     break
             except Exception as e:
@@ -172,9 +249,18 @@ class Scout(POGOAccount):
 
     def scout_by_encounter_id(self, job):
         self.log_info("Performing encounter request at {}, {}".format(job.lat, job.lng))
-        responses = self.req_encounter(job.encounter_id, job.spawn_point_id, float(job.lat), float(job.lng))
+        self.encounter_tokens.consume()
+        with StageTimer('encounter'):
+            responses = self.proxy_request(self.req_encounter, job.encounter_id, job.spawn_point_id,
+                                           float(job.lat), float(job.lng))
         self.update_history()
-        return self.parse_encounter_response(responses, job)
+
+        encounter = responses.get('ENCOUNTER') if responses else None
+        status = ENCOUNTER_RESULTS.get(encounter.status, 'UNKNOWN') if encounter else 'NO_RESPONSE'
+        count_encounter(self.username, self.proxy_url, status)
+
+        with StageTimer('parse'):
+            return self.parse_encounter_response(responses, job)
 
     def parse_encounter_response(self, responses, job):
         if not responses:
@@ -218,7 +304,7 @@ class Scout(POGOAccount):
         df = pokemon_info.individual_defense
         st = pokemon_info.individual_stamina
         iv = calc_iv(at, df, st)
-        moveset_grades = get_moveset_grades(job.pokemon_id, job.pokemon_name,
+        moveset_grades = get_moveset_grades(job.pokemon_id,
                                             pokemon_info.move_1,
                                             pokemon_info.move_2)
 
@@ -1,5 +1,10 @@
+import time
+from threading import Thread
+
 from pgscout.Scout import Scout
 from pgscout.config import use_pgpool
+from pgscout.metrics import observe_swap
+from pgscout.standby import take_standby_scout, login_scout
 from pgscout.utils import load_pgpool_accounts
 
 
@@ -27,16 +32,37 @@ class ScoutGuard(object):
             self.active = True
             self.acc.run()
             self.active = False
+            stopped = time.time()
+
+            if self.acc.retired:
+                # Give the account back to PGPool for other systems.
+                self.acc.release_account("Retired by autoscaler")
+                break
 
             # Scout terminated, probably (shadow)banned.
             if use_pgpool():
-                self.swap_account()
+                self.swap_account(stopped)
             else:
                 # Just stop.
                 self.active = False
                 break
 
-    def swap_account(self):
-        # First get new account, then release to avoid getting same account back.
-        self.acc.update_pgpool(release=True, reason=self.acc.last_msg)
-        self.acc = self.init_scout(load_pgpool_accounts(1))
+    def swap_account(self, stopped):
+        # Prefer an account that is already logged in, otherwise log in the
+        # new one right away where the old one stopped. The old account is
+        # released in the background to not delay the new one.
+        old_acc = self.acc
+        position = old_acc.last_position
+        standby = take_standby_scout()
+        if standby:
+            standby.last_position = position
+            self.acc = standby
+        else:
+            self.acc = self.init_scout(load_pgpool_accounts(1))
+            if position:
+                login_scout(self.acc, position)
+        observe_swap('standby' if standby else 'cold', time.time() - stopped)
+        t = Thread(target=old_acc.release_account, name="release_{}".format(old_acc.username),
+                   args=(old_acc.last_msg,))
+        t.daemon = True
+        t.start()
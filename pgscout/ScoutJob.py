@@ -1,10 +1,18 @@
+import logging
 import random
+import time
+from threading import Event, Lock
+from uuid import uuid4
 
-from pgscout.utils import get_pokemon_name
+from pgscout.utils import get_pokemon_name, get_pokemon_priority
+
+log = logging.getLogger(__name__)
 
 
 class ScoutJob(object):
-    def __init__(self, pokemon_id, encounter_id, spawn_point_id, lat, lng):
+    def __init__(self, pokemon_id, encounter_id, spawn_point_id, lat, lng, despawn_time=None, priority=None):
+        self.id = uuid4().hex
+        self.created = time.time()
         self.pokemon_id = int(pokemon_id)
         self.pokemon_name = get_pokemon_name(pokemon_id)
         self.encounter_id = encounter_id
@@ -14,5 +22,43 @@ class ScoutJob(object):
         self.processed = False
         self.result = {}
 
+        # Unix timestamp when the Pokemon despawns, if known
+        self.despawn_time = despawn_time
+        # Jobs with higher priority get scouted first
+        self.priority = get_pokemon_priority(self.pokemon_id) if priority is None else priority
+
         # Use fixed random altitude per job
-        self.altitude = random.randint(12, 108)
\ No newline at end of file
+        self.altitude = random.randint(12, 108)
+
+        # Gets set as soon as a scout is done with the job
+        self.processed_event = Event()
+        self.callbacks = []
+        self.callback_lock = Lock()
+        # Whether the result goes out through the webhook
+        self.webhook = False
+
+    def add_done_callback(self, callback):
+        # Callback gets called with the job once it has been processed, right
+        # away if that already happened.
+        with self.callback_lock:
+            if not self.processed:
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_processed(self):
+        with self.callback_lock:
+            self.processed = True
+            callbacks = self.callbacks
+            self.callbacks = []
+        # Run callbacks first so waiting requests find the result cached.
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                log.exception("Exception in job callback: {}".format(repr(e)))
+        self.processed_event.set()
+
+    def wait(self, timeout=None):
+        # Returns True if the job got processed within timeout seconds
+        return self.processed_event.wait(timeout)
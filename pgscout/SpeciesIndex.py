@@ -0,0 +1,79 @@
+import math
+import time
+from heapq import heappush, heappop
+from threading import Lock
+
+from pgscout.utils import get_distance, grid_cell, cell_width
+
+
+class SpeciesIndex(object):
+    # Entries indexed by Pokemon species and grid cell for lookups within a
+    # radius. Every entry has its own expiration time and replaces earlier
+    # entries with the same key in its cell.
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        # Maps (pokemon_id, cell) to list of (expires, lat, lng, key, value)
+        self.cells = {}
+        # Heap of (expires, cell key), one per added entry
+        self.expiry = []
+        self.lock = Lock()
+
+    def add(self, pokemon_id, lat, lng, key, value, expires):
+        cell_key = (pokemon_id, grid_cell(lat, lng, self.cell_size))
+        with self.lock:
+            entries = self.cells.setdefault(cell_key, [])
+            entries[:] = [e for e in entries if e[3] != key]
+            entries.append((expires, lat, lng, key, value))
+            heappush(self.expiry, (expires, cell_key))
+
+    def find(self, pokemon_id, lat, lng, radius):
+        # Returns (distance, value) of entries within radius meters, nearest
+        # first.
+        now = time.time()
+        cx, cy = grid_cell(lat, lng, self.cell_size)
+        span = int(math.ceil(radius / cell_width(lat, self.cell_size)))
+        found = []
+        with self.lock:
+            for x in range(cx - span, cx + span + 1):
+                for y in range(cy - span, cy + span + 1):
+                    for entry in self.cells.get((pokemon_id, (x, y)), []):
+                        if entry[0] <= now:
+                            continue
+                        d = get_distance(lat, lng, entry[1], entry[2])
+                        if d <= radius:
+                            found.append((d, entry[4]))
+        found.sort(key=lambda f: f[0])
+        return found
+
+    def remove(self, pokemon_id, lat, lng, radius, key):
+        # Removes the entry with the given key within radius meters.
+        cx, cy = grid_cell(lat, lng, self.cell_size)
+        span = int(math.ceil(radius / cell_width(lat, self.cell_size)))
+        with self.lock:
+            for x in range(cx - span, cx + span + 1):
+                for y in range(cy - span, cy + span + 1):
+                    cell_key = (pokemon_id, (x, y))
+                    entries = self.cells.get(cell_key)
+                    if entries:
+                        entries[:] = [e for e in entries if e[3] != key]
+                        if not entries:
+                            del self.cells[cell_key]
+
+    def cleanup(self):
+        # Removes expired entries and returns how many.
+        now = time.time()
+        num_deleted = 0
+        with self.lock:
+            while self.expiry and self.expiry[0][0] <= now:
+                _, cell_key = heappop(self.expiry)
+                entries = self.cells.get(cell_key)
+                if entries is None:
+                    continue
+                remaining = [e for e in entries if e[0] > now]
+                num_deleted += len(entries) - len(remaining)
+                if remaining:
+                    self.cells[cell_key] = remaining
+                else:
+                    del self.cells[cell_key]
+        return num_deleted
@@ -0,0 +1,67 @@
+import time
+from threading import Lock
+
+
+class TokenBucket(object):
+    # Refills at a fixed rate up to a maximum burst. A rate of 0 means
+    # unlimited, waiting never blocks then.
+
+    def __init__(self, per_minute, burst):
+        self.rate = per_minute / 60.0
+        self.capacity = float(max(burst, 1))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = Lock()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def level(self):
+        # Current number of tokens or None if unlimited.
+        if not self.rate:
+            return None
+        with self.lock:
+            self.refill()
+            return self.tokens
+
+    def wait_time(self):
+        # Seconds until a token is available, 0 if there is one already.
+        if not self.rate:
+            return 0
+        with self.lock:
+            self.refill()
+            return max(0, (1 - self.tokens) / self.rate)
+
+    def wait(self):
+        # Blocks until at least one token is available without taking it.
+        while self.rate:
+            with self.lock:
+                self.refill()
+                missing = 1 - self.tokens
+            if missing <= 0:
+                return
+            time.sleep(missing / self.rate)
+
+    def consume(self):
+        # Blocks until a token is available and takes it.
+        while self.rate:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                missing = 1 - self.tokens
+            time.sleep(missing / self.rate)
+
+    def try_consume(self):
+        # Takes a token if one is available, never blocks.
+        if not self.rate:
+            return True
+        with self.lock:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+        return False
@@ -0,0 +1,80 @@
+import logging
+import time
+from threading import Thread
+
+from pgscout.ScoutGuard import ScoutGuard
+from pgscout.config import cfg_get
+from pgscout.utils import load_pgpool_accounts, estimate_queue_wait
+
+log = logging.getLogger(__name__)
+
+
+def autoscaler_thread(scouts, jobs):
+    # Adds scouts from PGPool while the queue stays too long and releases
+    # idle ones once it stays empty. Conditions have to hold for a while and
+    # timers restart after every change to avoid flapping.
+    busy_since = None
+    idle_since = None
+    while True:
+        time.sleep(cfg_get('autoscale_interval'))
+        now = time.time()
+
+        if is_overloaded(scouts, jobs):
+            busy_since = busy_since or now
+            idle_since = None
+        elif jobs.qsize() == 0 and jobs.idle_count() > 0:
+            idle_since = idle_since or now
+            busy_since = None
+        else:
+            busy_since = idle_since = None
+
+        num_scouts = len(scouts)
+        if busy_since and now - busy_since >= cfg_get('autoscale_up_after') \
+                and num_scouts < cfg_get('autoscale_max'):
+            add_scouts(scouts, jobs, min(cfg_get('autoscale_step'), cfg_get('autoscale_max') - num_scouts))
+            busy_since = None
+        elif idle_since and now - idle_since >= cfg_get('autoscale_down_after') \
+                and num_scouts > cfg_get('autoscale_min'):
+            retire_scout(scouts, jobs)
+            idle_since = None
+
+
+def is_overloaded(scouts, jobs):
+    max_depth = cfg_get('autoscale_queue_depth')
+    if max_depth and jobs.qsize() > max_depth:
+        return True
+    max_wait = cfg_get('autoscale_queue_wait')
+    wait = estimate_queue_wait(scouts, jobs)
+    return bool(max_wait and wait is not None and wait > max_wait)
+
+
+def add_scouts(scouts, jobs, count):
+    try:
+        acc_json = load_pgpool_accounts(count)
+    except Exception as e:
+        log.error("Could not load accounts from PGPool: {}".format(repr(e)))
+        return
+    if isinstance(acc_json, dict):
+        acc_json = [acc_json]
+    if not acc_json:
+        log.warning("PGPool has no more accounts to add scouts.")
+        return
+
+    for acc in acc_json:
+        scout = ScoutGuard(acc['auth_service'], acc['username'], acc['password'], jobs)
+        t = Thread(target=scout.run)
+        t.daemon = True
+        t.start()
+        scouts.append(scout)
+    log.info("Queue too long. Added {} scouts, now running {}.".format(len(acc_json), len(scouts)))
+
+
+def retire_scout(scouts, jobs):
+    acc = jobs.retire_idle()
+    if acc is None:
+        return
+    for scout in scouts:
+        if scout.acc is acc:
+            scouts.remove(scout)
+            break
+    log.info("Queue empty. Retired scout {}, now running {}.".format(acc.username, len(scouts)))
@@ -1,34 +1,361 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+from collections import OrderedDict
+from hashlib import md5
+from heapq import heappush, heappop, heapify
 from threading import Lock
 
-import time
+from pgscout.config import cfg_get
+from pgscout.SpeciesIndex import SpeciesIndex
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+# Errors worth remembering for a short time. Asking again for a Pokemon that
+# fled or could not be found would just burn another encounter.
+negative_cache_errors = ['ENCOUNTER_NOT_FOUND', 'ENCOUNTER_CLOSED', 'ENCOUNTER_POKEMON_FLED',
+                         'ENCOUNTER_ALREADY_HAPPENED']
+
+encounter_cache = None
+
+# Cache keys of successful encounters by species and location, so requests
+# whose coordinates differ by a few meters from an earlier one still hit the
+# cache. Kept in-process for every backend, the results themselves stay in the
+# backend. Grid cells are ~11m.
+location_index = SpeciesIndex(0.0001)
+location_hits = 0
+
+
+class MemoryCache(object):
+    # LRU cache with an upper bound on entries and bytes. Entries expire by
+    # their own TTL, tracked in a heap so cleanup never scans the whole cache.
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Maps key to (data, size, expires), least recently used first
+        self.entries = OrderedDict()
+        # Heap of (expires, key), may contain outdated items of replaced keys
+        self.expiry = []
+        self.size = 0
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return False
+            if entry[2] <= now:
+                self.size -= entry[1]
+                self.expirations += 1
+                self.misses += 1
+                return False
+            # Re-insert to mark as most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, data, ttl):
+        size = len(json.dumps(data))
+        expires = time.time() + ttl
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (data, size, expires)
+            self.size += size
+            heappush(self.expiry, (expires, key))
+
+            while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+                _, (_, old_size, _) = self.entries.popitem(last=False)
+                self.size -= old_size
+                self.evictions += 1
+
+            # Drop outdated heap items once they outnumber live entries
+            if len(self.expiry) > 2 * len(self.entries) + 1000:
+                self.expiry = [(e[2], k) for k, e in self.entries.iteritems()]
+                heapify(self.expiry)
+
+    def cleanup(self):
+        now = time.time()
+        num_deleted = 0
+        with self.lock:
+            while self.expiry and self.expiry[0][0] <= now:
+                expires, key = heappop(self.expiry)
+                entry = self.entries.get(key)
+                # Only remove if the heap item still belongs to this entry
+                if entry is not None and entry[2] == expires:
+                    del self.entries[key]
+                    self.size -= entry[1]
+                    self.expirations += 1
+                    num_deleted += 1
+        return num_deleted
+
+    def count(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+
+class FileCache(object):
+    # Hash table in a memory-mapped file that all PGScout processes on the
+    # same host can share. It also survives restarts. Each slot holds one
+    # entry, colliding keys are placed in the next few slots. When all of
+    # them are in use the oldest entry gets overwritten.
+
+    magic = 'PGSC'
+    version = 1
+    # magic, version, number of slots, slot size, number of used slots
+    header = struct.Struct('<4sIIIQ')
+    header_size = 64
+    # key hash (0 = empty), expires, stored, payload length
+    slot_header = struct.Struct('<QddI')
+    max_probes = 8
+
+    def __init__(self, filename, slots, slot_size):
+        if fcntl is None:
+            log.error("The file cache backend needs fcntl which is not available on this platform.")
+            sys.exit(1)
+        self.slots = slots
+        self.slot_size = slot_size
+        self.lock = Lock()
+
+        size = self.header_size + slots * slot_size
+        self.file = os.open(filename, os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        new_file = os.fstat(self.file).st_size == 0
+        if new_file:
+            os.ftruncate(self.file, size)
+        self.map = mmap.mmap(self.file, os.fstat(self.file).st_size)
+        if new_file:
+            self.header.pack_into(self.map, 0, self.magic, self.version, slots, slot_size, 0)
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+
+        magic, version, file_slots, file_slot_size, _ = self.header.unpack_from(self.map, 0)
+        if magic != self.magic or version != self.version or file_slots != slots or file_slot_size != slot_size:
+            log.error("Cache file {} has a different format or size. Delete it or adjust the cache settings.".format(
+                filename))
+            sys.exit(1)
+        log.info("Using shared encounter cache file {} with {} slots.".format(filename, slots))
 
-cache_lock = Lock()
-encounter_cache = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key_hash(self, key):
+        h = struct.unpack('<Q', md5(str(key)).digest()[:8])[0]
+        return h or 1
+
+    def slot_offsets(self, h):
+        first = h % self.slots
+        for i in range(self.max_probes):
+            yield self.header_size + ((first + i) % self.slots) * self.slot_size
+
+    def get(self, key):
+        h = self.key_hash(key)
+        now = time.time()
+        with self.lock:
+            fcntl.flock(self.file, fcntl.LOCK_SH)
+            try:
+                for offset in self.slot_offsets(h):
+                    slot_hash, expires, _, length = self.slot_header.unpack_from(self.map, offset)
+                    if slot_hash != h or expires <= now:
+                        continue
+                    start = offset + self.slot_header.size
+                    stored_key, data = json.loads(self.map[start:start + length])
+                    if stored_key == str(key):
+                        self.hits += 1
+                        return data
+            finally:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.misses += 1
+        return False
+
+    def put(self, key, data, ttl):
+        payload = json.dumps([str(key), data])
+        if len(payload) > self.slot_size - self.slot_header.size:
+            log.warning("Encounter {} too large for cache slot.".format(key))
+            return
+        h = self.key_hash(key)
+        now = time.time()
+        with self.lock:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+            try:
+                target = None
+                target_stored = None
+                target_state = None
+                for offset in self.slot_offsets(h):
+                    slot_hash, expires, stored, _ = self.slot_header.unpack_from(self.map, offset)
+                    if slot_hash == h:
+                        target, target_state = offset, 'replace'
+                        break
+                    if slot_hash == 0:
+                        if target_state != 'free':
+                            target, target_state = offset, 'free'
+                    elif target_state not in ['free', 'expired']:
+                        if expires <= now:
+                            target, target_state = offset, 'expired'
+                        elif target_stored is None or stored < target_stored:
+                            target, target_stored, target_state = offset, stored, 'evict'
+
+                if target_state == 'free':
+                    used = self.header.unpack_from(self.map, 0)[4]
+                    struct.pack_into('<Q', self.map, 16, used + 1)
+                elif target_state == 'evict':
+                    self.evictions += 1
+                self.slot_header.pack_into(self.map, target, h, now + ttl, now, len(payload))
+                start = target + self.slot_header.size
+                self.map[start:start + len(payload)] = payload
+            finally:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def cleanup(self):
+        # Expired slots simply get reused.
+        return 0
+
+    def count(self):
+        return self.header.unpack_from(self.map, 0)[4]
+
+    def stats(self):
+        return {
+            'entries': self.count(),
+            'bytes': self.count() * self.slot_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': 0
+        }
+
+
+class RedisCache(object):
+    # Keeps encounters in Redis (or anything speaking its protocol) so
+    # PGScout instances on different hosts can share them.
+
+    key_prefix = 'pgscout:encounter:'
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            log.error("The redis cache backend needs the redis package: pip install redis")
+            sys.exit(1)
+        self.client = redis.StrictRedis.from_url(url, socket_timeout=1)
+        log.info("Using shared encounter cache at {}.".format(url))
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            data = self.client.get(self.key_prefix + str(key))
+        except Exception as e:
+            log.warning("Could not read from encounter cache: {}".format(repr(e)))
+            data = None
+        if data is None:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return json.loads(data)
+
+    def put(self, key, data, ttl):
+        try:
+            self.client.setex(self.key_prefix + str(key), int(ttl), json.dumps(data))
+        except Exception as e:
+            log.warning("Could not write to encounter cache: {}".format(repr(e)))
+
+    def cleanup(self):
+        # Redis expires keys itself.
+        return 0
+
+    def count(self):
+        try:
+            return self.client.dbsize()
+        except Exception:
+            return 0
+
+    def stats(self):
+        return {
+            'entries': self.count(),
+            'bytes': 0,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': 0,
+            'expirations': 0
+        }
+
+
+def init_cache():
+    global encounter_cache
+    backend = cfg_get('cache_backend')
+    if backend == 'file':
+        encounter_cache = FileCache(cfg_get('cache_file'), cfg_get('cache_file_slots'), cfg_get('cache_file_slot_size'))
+    elif backend == 'redis':
+        encounter_cache = RedisCache(cfg_get('cache_redis_url'))
+    else:
+        encounter_cache = MemoryCache(cfg_get('cache_max_entries'), cfg_get('cache_max_mb') * 1024 * 1024)
 
 
 def get_cached_count():
-    return len(encounter_cache)
+    return encounter_cache.count()
+
 
+def get_cache_stats():
+    stats = encounter_cache.stats()
+    stats['location_hits'] = location_hits
+    return stats
 
-def get_cached_encounter(encounter_id):
-    return encounter_cache.get(encounter_id, False)
 
+def get_cached_encounter(cache_key, pokemon_id=None, lat=None, lng=None):
+    # Falls back to results for the same species within the configured
+    # tolerance if a location is given.
+    global location_hits
+    result = encounter_cache.get(cache_key)
+    if result or pokemon_id is None or not cfg_get('cache_location_tolerance'):
+        return result
+    for _, nearby_key in location_index.find(pokemon_id, lat, lng, cfg_get('cache_location_tolerance')):
+        result = encounter_cache.get(nearby_key)
+        if result:
+            location_hits += 1
+            return result
+    return False
 
-def cache_encounter(encounter_id, encounter_data):
-    cache_lock.acquire()
-    encounter_cache[encounter_id] = encounter_data
-    cache_lock.release()
+
+def cache_encounter(cache_key, encounter_data, pokemon_id=None, lat=None, lng=None):
+    if encounter_data.get('success'):
+        encounter_cache.put(cache_key, encounter_data, cfg_get('cache_ttl'))
+        if pokemon_id is not None and cfg_get('cache_location_tolerance'):
+            location_index.add(pokemon_id, lat, lng, cache_key, cache_key,
+                               time.time() + min(cfg_get('cache_ttl'), cfg_get('cache_location_ttl')))
+    elif encounter_data.get('error') in negative_cache_errors:
+        encounter_cache.put(cache_key, encounter_data, cfg_get('cache_negative_ttl'))
 
 
 def cleanup_cache():
-    # Remove all entries from encounter cache older than 1 hour.
-    now = time.time()
-    cache_lock.acquire()
-    num_deleted = 0
-    for encounter_id in encounter_cache.keys():
-        encounter = encounter_cache[encounter_id]
-        if now - encounter['encountered_time'] > 60 * 60:
-            del encounter_cache[encounter_id]
-            num_deleted += 1
-    cache_lock.release()
-    return num_deleted
+    # Remove all entries from encounter cache that have expired.
+    location_index.cleanup()
+    return encounter_cache.cleanup()
+
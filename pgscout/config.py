@@ -4,8 +4,9 @@ import sys
 
 import configargparse
 from mrmime import init_mr_mime
-from mrmime.cyclicresourceprovider import CyclicResourceProvider
 
+from pgscout.HashKeyScheduler import HashKeyScheduler
+from pgscout.ProxyManager import ProxyManager
 from pgscout.proxy import check_proxies
 
 log = logging.getLogger(__name__)
@@ -37,11 +38,119 @@ def parse_args():
                         help='Port to bind to.')
 
     parser.add_argument('-hk', '--hash-key', required=True, action='append',
-                        help='Hash key(s) to use.')
+                        help='Hash key(s) to use. Append ":<rpm>" to set the requests per minute of a key.')
+
+    parser.add_argument('-hkr', '--hash-key-rpm', type=int, default=150,
+                        help='Requests per minute of hash keys without explicit RPM.')
+
+    parser.add_argument('-hkb', '--hash-key-backoff', type=int, default=60,
+                        help='Do not use a hash key for this many seconds after it exceeded its quota.')
 
     parser.add_argument('-pf', '--proxies-file',
                         help='Load proxy list from text file (one proxy per line).')
 
+    parser.add_argument('-pct', '--proxy-check-threads', type=int, default=20,
+                        help='Number of proxies to check at the same time.')
+
+    parser.add_argument('-pcr', '--proxy-check-retries', type=int, default=1,
+                        help='Check a failing proxy this many more times before giving up on it.')
+
+    parser.add_argument('-pcto', '--proxy-check-timeout', type=int, default=5,
+                        help='Timeout in seconds of a single proxy check.')
+
+    parser.add_argument('-pci', '--proxy-check-interval', type=int, default=600,
+                        help='Check all proxies in the proxy file again every this many seconds. 0 to disable.')
+
+    parser.add_argument('-pef', '--proxy-eject-failures', type=int, default=5,
+                        help='Stop using a proxy for a while after this many failed requests in a row.')
+
+    parser.add_argument('-pet', '--proxy-eject-time', type=int, default=300,
+                        help='Number of seconds a failing or banned proxy is not used.')
+
+    parser.add_argument('-ptu', '--proxy-test-url', default='https://pgorelease.nianticlabs.com/plfe/rpc',
+                        help='URL proxies get checked against.')
+
+    parser.add_argument('-it', '--iv-timeout', type=int, default=120,
+                        help='Return an error if an /iv request has not been processed after this many seconds.')
+
+    parser.add_argument('-cb', '--cache-backend', default='memory', choices=['memory', 'file', 'redis'],
+                        help='Where to keep cached encounters. "file" shares them between PGScout instances on the ' +
+                             'same host and keeps them across restarts, "redis" shares them across hosts.')
+
+    parser.add_argument('-cf', '--cache-file', default='encounter_cache.bin',
+                        help='File for the "file" cache backend.')
+
+    parser.add_argument('-cfs', '--cache-file-slots', type=int, default=65536,
+                        help='Number of encounters the "file" cache backend can hold.')
+
+    parser.add_argument('-cfss', '--cache-file-slot-size', type=int, default=2048,
+                        help='Maximum size of one encounter in the "file" cache backend in bytes.')
+
+    parser.add_argument('-cru', '--cache-redis-url', default='redis://localhost:6379/0',
+                        help='Redis URL for the "redis" cache backend. Use a dedicated database.')
+
+    parser.add_argument('-cme', '--cache-max-entries', type=int, default=100000,
+                        help='Maximum number of encounters to keep in the cache. Least recently used ones get evicted.')
+
+    parser.add_argument('-cmm', '--cache-max-mb', type=int, default=128,
+                        help='Maximum size of the encounter cache in megabytes.')
+
+    parser.add_argument('-ct', '--cache-ttl', type=int, default=3600,
+                        help='Number of seconds to keep encounter results in the cache.')
+
+    parser.add_argument('-cnt', '--cache-negative-ttl', type=int, default=60,
+                        help='Number of seconds to cache "not found" and "fled" encounter errors.')
+
+    parser.add_argument('-clt', '--cache-location-tolerance', type=float, default=5,
+                        help='Answer requests without encounter ID from cached results of the same Pokemon ' +
+                             'within this many meters. 0 to disable.')
+
+    parser.add_argument('-clttl', '--cache-location-ttl', type=int, default=1800,
+                        help='Number of seconds cached results can be found by location. Keep this below the ' +
+                             'respawn interval so a new spawn is not answered with the old result.')
+
+    parser.add_argument('-mqw', '--max-queue-wait', type=int, default=0,
+                        help='Reject new jobs with HTTP 503 if the estimated queue wait exceeds this many seconds. ' +
+                             '0 disables admission control.')
+
+    parser.add_argument('-jrt', '--job-result-ttl', type=int, default=3600,
+                        help='Keep results of jobs submitted to /jobs this many seconds.')
+
+    parser.add_argument('-wh', '--webhook-url',
+                        help='Post results of jobs submitted to /jobs to this URL.')
+
+    parser.add_argument('-whbs', '--webhook-batch-size', type=int, default=50,
+                        help='Maximum number of results per webhook request.')
+
+    parser.add_argument('-whi', '--webhook-interval', type=float, default=1.0,
+                        help='Collect results this many seconds before sending a webhook request.')
+
+    parser.add_argument('-whr', '--webhook-retries', type=int, default=3,
+                        help='Retry failed webhook requests this many times.')
+
+    parser.add_argument('-wht', '--webhook-timeout', type=float, default=5.0,
+                        help='Timeout of webhook requests in seconds.')
+
+    parser.add_argument('-jmt', '--job-min-time', type=int, default=10,
+                        help='Drop queued jobs whose Pokemon despawns in less than this many seconds.')
+
+    parser.add_argument('-prf', '--priority-file',
+                        help='JSON file mapping Pokemon IDs to job priorities. Jobs with higher priority get ' +
+                             'scouted first. Default: 1 for rare, 0 for common Pokemon.')
+
+    parser.add_argument('-gct', '--gmo-cache-ttl', type=int, default=60,
+                        help='Remember wild Pokemon seen by GetMapObjects this many seconds to find ' +
+                             'encounter IDs of later jobs without another GMO request.')
+
+    parser.add_argument('-gcr', '--gmo-cache-radius', type=float, default=70,
+                        help='Maximum distance in meters between a job and a remembered wild Pokemon.')
+
+    parser.add_argument('-mgf', '--moveset-grades-file', default='moveset_grades.json',
+                        help='Moveset grade table built by pgscout-grades.py.')
+
+    parser.add_argument('-mgr', '--moveset-grades-reload', type=int, default=300,
+                        help='Check the moveset grade table for changes every this many seconds. 0 to disable.')
+
     parser.add_argument('-l', '--level', type=int, default=30,
                         help='Minimum trainer level required. Lower levels will yield an error.')
 
@@ -49,6 +158,17 @@ def parse_args():
                         help='Mark an account as shadowbanned after this many errors. ' +
                              'If --pgpool_url is specified the account gets swapped out.')
 
+    parser.add_argument('-epm', '--encounters-per-minute', type=float, default=0,
+                        help='Maximum encounter requests per account and minute. 0 for no limit.')
+
+    parser.add_argument('-gpm', '--gmos-per-minute', type=float, default=0,
+                        help='Maximum GetMapObjects requests per account and minute. Accounts over ' +
+                             'the limit only get jobs with encounter_id. 0 for no limit.')
+
+    parser.add_argument('-rb', '--rate-burst', type=int, default=3,
+                        help='Number of requests an account may send at once after pausing, ' +
+                             'if requests per minute are limited.')
+
     parser.add_argument('-iv', '--initial-view', default="logs",
                         help=('Initial view. Can be one of "logs", "scouts" or "pokemon". Default is "logs".'))
 
@@ -58,6 +178,54 @@ def parse_args():
     parser.add_argument('-pgpsid', '--pgpool-system-id',
                         help='System ID for PGPool. Required if --pgpool-url given.')
 
+    parser.add_argument('-asmax', '--autoscale-max', type=int, default=0,
+                        help='Add scouts with accounts from PGPool while the queue is too long, up to this many. ' +
+                             '0 to disable autoscaling.')
+
+    parser.add_argument('-asmin', '--autoscale-min', type=int, default=1,
+                        help='Release idle scouts to PGPool while the queue is empty, down to this many.')
+
+    parser.add_argument('-asqd', '--autoscale-queue-depth', type=int, default=20,
+                        help='Queue is too long if more jobs than this are waiting. 0 to ignore queue depth.')
+
+    parser.add_argument('-asqw', '--autoscale-queue-wait', type=int, default=60,
+                        help='Queue is too long if the estimated queue wait exceeds this many seconds. ' +
+                             '0 to ignore queue wait.')
+
+    parser.add_argument('-asua', '--autoscale-up-after', type=int, default=60,
+                        help='Add scouts once the queue was too long for this many seconds.')
+
+    parser.add_argument('-asda', '--autoscale-down-after', type=int, default=300,
+                        help='Retire an idle scout once the queue was empty for this many seconds.')
+
+    parser.add_argument('-ass', '--autoscale-step', type=int, default=2,
+                        help='Maximum number of scouts to add at once.')
+
+    parser.add_argument('-asi', '--autoscale-interval', type=int, default=10,
+                        help='Check the queue for autoscaling every this many seconds.')
+
+    parser.add_argument('-el', '--eager-login', action='store_true', default=False,
+                        help='Log in all scouts at startup before accepting requests.')
+
+    parser.add_argument('-ell', '--eager-login-location',
+                        help='Location to log in scouts at startup as "lat,lng". Required for --eager-login.')
+
+    parser.add_argument('-elt', '--eager-login-threads', type=int, default=10,
+                        help='Number of scouts to log in at the same time at startup.')
+
+    parser.add_argument('-eld', '--eager-login-delay', type=float, default=0.5,
+                        help='Seconds between the starts of two logins at startup.')
+
+    parser.add_argument('-rf', '--ready-fraction', type=float, default=0.5,
+                        help='Accept requests once this fraction of scouts is logged in at startup.')
+
+    parser.add_argument('-sa', '--standby-accounts', type=int, default=0,
+                        help='Keep this many accounts from PGPool logged in to replace banned scouts instantly.')
+
+    parser.add_argument('-sr', '--standby-refresh', type=int, default=15,
+                        help='Update standby accounts in PGPool and check their login every this many minutes, ' +
+                             'so PGPool does not release them and their session stays valid. 0 to disable.')
+
     accs = parser.add_mutually_exclusive_group(required=True)
     accs.add_argument('-pgpn', '--pgpool-num-accounts', type=int, default=0,
                       help='Use this many accounts from PGPool. --pgpool-url required.')
@@ -89,10 +257,16 @@ def cfg_init():
 
     parse_args()
 
+    if args.eager_login and not args.eager_login_location:
+        log.error("--eager-login needs --eager-login-location.")
+        sys.exit(1)
+
     # MrMime config
     mrmime_cfg = {
         'pgpool_system_id': args.pgpool_system_id,
-        'exception_on_captcha': True
+        'exception_on_captcha': True,
+        # PGScout picks another hash key itself
+        'retry_on_hash_quota_exceeded': False
     }
     if args.pgpool_url:
         mrmime_cfg['pgpool_url'] = args.pgpool_url
@@ -100,15 +274,15 @@ def cfg_init():
     init_mr_mime(mrmime_cfg)
 
     # Collect hash keys
-    args.hash_key_provider = CyclicResourceProvider()
+    args.hash_key_provider = HashKeyScheduler(args.hash_key_rpm, args.hash_key_backoff)
     for hk in args.hash_key:
         args.hash_key_provider.add_resource(hk)
 
     # Collect proxies
-    args.proxies = check_proxies(cfg_get('proxies_file'))
-    args.proxy_provider = CyclicResourceProvider()
-    for proxy in args.proxies:
-        args.proxy_provider.add_resource(proxy)
+    args.proxies, latencies = check_proxies(cfg_get('proxies_file'), args.proxy_test_url, args.proxy_check_timeout,
+                                            args.proxy_check_retries, args.proxy_check_threads)
+    args.proxy_provider = ProxyManager(args.proxy_eject_failures, args.proxy_eject_time)
+    args.proxy_provider.set_proxies(args.proxies, latencies)
 
 
 def use_pgpool():
@@ -10,10 +10,14 @@ import time
 from datetime import datetime
 from threading import Thread
 
-from pgscout.cache import get_cached_count
+from pgscout.cache import get_cached_count, get_cache_stats
 from pgscout.config import cfg_get
+from pgscout.gmo_cache import get_gmo_cache_hits
+from pgscout.inflight import get_coalesced_count
+from pgscout.standby import get_standby_count
+from pgscout.startup import get_login_state
 from pgscout.stats import get_pokemon_stats
-from pgscout.utils import get_pokemon_name, rss_mem_size, app_state
+from pgscout.utils import get_pokemon_name, rss_mem_size, app_state, estimate_queue_wait
 
 default_log_level = 0
 
@@ -72,9 +76,17 @@ def print_status(scouts, initial_display, jobs):
             continue
 
         lines = []
+        queue_wait = estimate_queue_wait(scouts, jobs)
         lines.append(
-            "Accepting requests: {} | Job queue length: {} | Cached encounters: {} | Mem Usage: {}".format(
-                app_state.accept_new_requests, jobs.qsize(), get_cached_count(), rss_mem_size()))
+            "Accepting requests: {} | Logged in: {} | Job queue length: {} | Est. queue wait: {} | Cached encounters: {} | Saved encounters: {} | Saved GMOs: {} | Mem Usage: {}".format(
+                app_state.accept_new_requests, login_status(scouts), jobs.qsize(), '-' if queue_wait is None else "{:.0f}s".format(queue_wait),
+                get_cached_count(), get_coalesced_count(), get_gmo_cache_hits(), rss_mem_size()))
+        cstats = get_cache_stats()
+        lines.append(
+            "Cache: {:.1f} MB | Hits: {} | Nearby hits: {} | Misses: {} | Evictions: {} | Expired: {} | Idle scouts: {} | Avg jump: {:.0f} m | Despawned jobs: {} | Standby: {}".format(
+                cstats['bytes'] / 1024.0 / 1024.0, cstats['hits'], cstats['location_hits'], cstats['misses'], cstats['evictions'],
+                cstats['expirations'], jobs.idle_count(), jobs.average_jump_distance(), jobs.num_expired,
+                get_standby_count()))
 
         if state['display'] == 'scouts':
             total_pages = print_scouts(lines, state, scouts)
@@ -100,9 +112,11 @@ def print_scouts(lines, state, scouts):
         active = 'Yes' if scout_guard.active else 'No'
         if cfg_get('proxies'):
             return line_tmpl.format(current_line, scout.username, scout.proxy_url,
+                                    cfg_get('proxy_provider').health(scout.proxy_url),
                                     hr_tstamp(scout.start_time), warn_str, active,
                                     scout.total_encounters,
                                     "{:5.1f}".format(scout.encounters_per_hour),
+                                    token_levels(scout),
                                     scout.errors,
                                     hr_tstamp(scout.previous_encounter),
                                     scout.last_msg)
@@ -112,6 +126,7 @@ def print_scouts(lines, state, scouts):
                                     hr_tstamp(scout.start_time), warn_str, active,
                                     scout.total_encounters,
                                     "{:5.1f}".format(scout.encounters_per_hour),
+                                    token_levels(scout),
                                     scout.errors,
                                     hr_tstamp(scout.previous_encounter),
                                     scout.last_msg)
@@ -120,15 +135,27 @@ def print_scouts(lines, state, scouts):
                               map(lambda s: len(s.acc.username), scouts)))
     len_num = str(len(str(len(scouts))))
     if cfg_get('proxies'):
-        line_tmpl = u'{:' + len_num + '} | {:' + len_username + '} | {:25} | {:8} | {:4} | {:6} | {:10} | {:6} | {:6} |{:14} | {}'
+        line_tmpl = u'{:' + len_num + '} | {:' + len_username + '} | {:25} | {:12} | {:8} | {:4} | {:6} | {:10} | {:6} | {:10} | {:6} |{:14} | {}'
         lines.append(
-            line_tmpl.format('#', 'Scout', 'Proxy', 'Start', 'Warn', 'Active', 'Encounters', 'Enc/h', 'Errors',
+            line_tmpl.format('#', 'Scout', 'Proxy', 'Proxy health', 'Start', 'Warn', 'Active', 'Encounters', 'Enc/h', 'Tokens E/G', 'Errors',
                              'Last Encounter', 'Message'))
     else:
-        line_tmpl = u'{:' + len_num + '} | {:' + len_username + '} | {:8} | {:4} | {:6} | {:10} | {:6} | {:6} | {:14} | {}'
-        lines.append(line_tmpl.format('#', 'Scout', 'Start', 'Warn', 'Active', 'Encounters', 'Enc/h', 'Errors',
+        line_tmpl = u'{:' + len_num + '} | {:' + len_username + '} | {:8} | {:4} | {:6} | {:10} | {:6} | {:10} | {:6} | {:14} | {}'
+        lines.append(line_tmpl.format('#', 'Scout', 'Start', 'Warn', 'Active', 'Encounters', 'Enc/h', 'Tokens E/G', 'Errors',
                                       'Last Encounter', 'Message'))
-    return print_lines(lines, scout_line, scouts, 4, state)
+    return print_lines(lines, scout_line, scouts, 5, state)
+
+
+def login_status(scouts):
+    state = get_login_state()
+    if not state['total']:
+        return '-'
+    return "{}/{}{}".format(state['ready'], state['total'], ' (starting)' if state['starting'] else '')
+
+
+def token_levels(scout):
+    levels = [scout.encounter_tokens.level(), scout.gmo_tokens.level()]
+    return '/'.join('-' if l is None else "{:.1f}".format(l) for l in levels)
 
 
 def print_pokemon(lines, state):
@@ -138,7 +165,7 @@ def print_pokemon(lines, state):
     line_tmpl = u'{:20} | {:10}'
     lines.append(line_tmpl.format('Pokemon', 'Encounters'))
     pstats = get_pokemon_stats()
-    return print_lines(lines, format_pstat_line, pstats, 4, state)
+    return print_lines(lines, format_pstat_line, pstats, 5, state)
 
 
 def print_lines(lines, print_entity, entities, addl_lines, state):
@@ -0,0 +1,51 @@
+import time
+from threading import Lock
+
+from pgscout.config import cfg_get
+from pgscout.SpeciesIndex import SpeciesIndex
+
+# Wild Pokemon seen in GetMapObjects responses of any scout. Values are
+# (encounter_id, spawn_point_id), grid cells are ~110m.
+sightings = SpeciesIndex(0.001)
+
+gmo_cache_hits = 0
+gmo_lock = Lock()
+
+# Encounter errors meaning a sighting is outdated
+stale_sighting_errors = ['ENCOUNTER_NOT_FOUND', 'ENCOUNTER_CLOSED', 'ENCOUNTER_POKEMON_FLED']
+
+
+def get_gmo_cache_hits():
+    return gmo_cache_hits
+
+
+def index_wild_pokemon(wild_pokemon):
+    now = time.time()
+    for pkm in wild_pokemon:
+        expires = now + cfg_get('gmo_cache_ttl')
+        if 0 < pkm.time_till_hidden_ms < cfg_get('gmo_cache_ttl') * 1000:
+            expires = now + pkm.time_till_hidden_ms / 1000.0
+        sightings.add(pkm.pokemon_data.pokemon_id, pkm.latitude, pkm.longitude, pkm.encounter_id,
+                      (pkm.encounter_id, pkm.spawn_point_id), expires)
+
+
+def lookup_wild_pokemon(job):
+    # Sets encounter_id and spawn_point_id of the job if a recent
+    # GetMapObjects saw a Pokemon of this species close enough.
+    global gmo_cache_hits
+    found = sightings.find(job.pokemon_id, job.lat, job.lng, cfg_get('gmo_cache_radius'))
+    if not found:
+        return False
+    with gmo_lock:
+        gmo_cache_hits += 1
+    job.encounter_id, job.spawn_point_id = found[0][1]
+    return True
+
+
+def forget_wild_pokemon(job):
+    # Drops the sighting lookup_wild_pokemon found for the job.
+    sightings.remove(job.pokemon_id, job.lat, job.lng, cfg_get('gmo_cache_radius'), job.encounter_id)
+
+
+def cleanup_gmo_cache():
+    return sightings.cleanup()
@@ -0,0 +1,45 @@
+from threading import Lock
+
+# Jobs currently queued or being scouted, by cache key
+inflight_jobs = {}
+inflight_lock = Lock()
+
+# Number of requests that got attached to an already running job and thus
+# didn't cost an extra encounter.
+coalesced_requests = 0
+
+
+def get_coalesced_count():
+    return coalesced_requests
+
+
+def get_inflight_count():
+    return len(inflight_jobs)
+
+
+def is_inflight(cache_key):
+    return cache_key in inflight_jobs
+
+
+def submit_job(cache_key, job, job_queue):
+    # Returns the job already running for cache_key or enqueues the given one.
+    global coalesced_requests
+    inflight_lock.acquire()
+    running = inflight_jobs.get(cache_key)
+    if running:
+        coalesced_requests += 1
+        inflight_lock.release()
+        return running
+    inflight_jobs[cache_key] = job
+    inflight_lock.release()
+
+    job.add_done_callback(lambda j: job_done(cache_key, j))
+    job_queue.put(job)
+    return job
+
+
+def job_done(cache_key, job):
+    inflight_lock.acquire()
+    if inflight_jobs.get(cache_key) is job:
+        del inflight_jobs[cache_key]
+    inflight_lock.release()
@@ -0,0 +1,39 @@
+import time
+from threading import Lock
+
+from pgscout.config import cfg_get
+
+# Jobs submitted through the asynchronous API, by job ID. Maps to
+# (job, time the job was stored).
+stored_jobs = {}
+jobs_lock = Lock()
+
+
+def get_stored_count():
+    return len(stored_jobs)
+
+
+def store_job(job):
+    jobs_lock.acquire()
+    stored_jobs[job.id] = (job, time.time())
+    jobs_lock.release()
+
+
+def get_stored_job(job_id):
+    entry = stored_jobs.get(job_id)
+    return entry[0] if entry else None
+
+
+def cleanup_jobs():
+    # Forget processed jobs whose result has been kept long enough.
+    now = time.time()
+    ttl = cfg_get('job_result_ttl')
+    jobs_lock.acquire()
+    num_deleted = 0
+    for job_id in stored_jobs.keys():
+        job, stored = stored_jobs[job_id]
+        if job.processed and now - stored > ttl:
+            del stored_jobs[job_id]
+            num_deleted += 1
+    jobs_lock.release()
+    return num_deleted
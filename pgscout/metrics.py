@@ -0,0 +1,165 @@
+import time
+from threading import Lock
+from urlparse import urlparse
+
+from pgscout.cache import get_cache_stats
+from pgscout.config import cfg_get
+
+# Prometheus text exposition of PGScout internals. Everything is kept in
+# plain dicts guarded by one lock, rendering happens on each scrape.
+
+# Upper bounds of histogram buckets in seconds
+STAGE_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+# Stages of a job, in the order they happen
+STAGES = ['queue_wait', 'login', 'gmo', 'encounter', 'parse']
+
+# Maps stage to [bucket counts, sum, count]
+stage_histograms = dict((stage, [[0] * len(STAGE_BUCKETS), 0.0, 0]) for stage in STAGES)
+
+# Where the account came from when a scout swapped accounts
+SWAP_SOURCES = ['standby', 'cold']
+
+# Maps swap source to [bucket counts, sum, count] of swap dead times
+swap_histograms = dict((source, [[0] * len(STAGE_BUCKETS), 0.0, 0]) for source in SWAP_SOURCES)
+# Maps (username, status) to number of encounter requests
+scout_encounters = {}
+# Maps (proxy, status) to number of encounter requests
+proxy_encounters = {}
+metrics_lock = Lock()
+
+
+class StageTimer(object):
+    # Context manager observing the duration of a stage.
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe_stage(self.stage, time.time() - self.start)
+        return False
+
+
+def observe_stage(stage, seconds):
+    observe(stage_histograms[stage], seconds)
+
+
+def observe_swap(source, seconds):
+    observe(swap_histograms[source], seconds)
+
+
+def observe(histogram, seconds):
+    metrics_lock.acquire()
+    for i, bound in enumerate(STAGE_BUCKETS):
+        if seconds <= bound:
+            histogram[0][i] += 1
+    histogram[1] += seconds
+    histogram[2] += 1
+    metrics_lock.release()
+
+
+def count_encounter(username, proxy_url, status):
+    proxy = strip_credentials(proxy_url) if proxy_url else 'none'
+    metrics_lock.acquire()
+    scout_encounters[(username, status)] = scout_encounters.get((username, status), 0) + 1
+    proxy_encounters[(proxy, status)] = proxy_encounters.get((proxy, status), 0) + 1
+    metrics_lock.release()
+
+
+def strip_credentials(proxy_url):
+    # Never expose proxy passwords on the metrics page.
+    parts = urlparse(proxy_url)
+    if parts.username is None:
+        return proxy_url
+    host = parts.hostname + (':{}'.format(parts.port) if parts.port else '')
+    return '{}://{}'.format(parts.scheme, host)
+
+
+def render_metrics(scouts, jobs):
+    lines = []
+
+    def metric(name, mtype, help_text, samples):
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, mtype))
+        for labels, value in samples:
+            lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+
+    metrics_lock.acquire()
+    try:
+        histogram_metric(lines, 'pgscout_stage_duration_seconds', 'Time spent in each stage of a scout job.',
+                         'stage', STAGES, stage_histograms)
+        histogram_metric(lines, 'pgscout_swap_dead_time_seconds',
+                         'Time a scout could not take jobs while swapping its account.',
+                         'source', SWAP_SOURCES, swap_histograms)
+
+        metric('pgscout_scout_encounters_total', 'counter', 'Encounter requests by scout and result status.',
+               [([('scout', u), ('status', s)], v) for (u, s), v in sorted(scout_encounters.items())])
+        metric('pgscout_proxy_encounters_total', 'counter', 'Encounter requests by proxy and result status.',
+               [([('proxy', p), ('status', s)], v) for (p, s), v in sorted(proxy_encounters.items())])
+        statuses = {}
+        for (_, status), value in scout_encounters.iteritems():
+            statuses[status] = statuses.get(status, 0) + value
+        metric('pgscout_encounter_results_total', 'counter', 'Encounter requests by result status.',
+               [([('status', s)], v) for s, v in sorted(statuses.items())])
+    finally:
+        metrics_lock.release()
+
+    metric('pgscout_scout_encounters_per_hour', 'gauge', 'Current encounter rate of each scout.',
+           [([('scout', g.acc.username)], g.acc.encounters_per_hour) for g in scouts])
+    metric('pgscout_scout_active', 'gauge', 'Whether the scout is running.',
+           [([('scout', g.acc.username)], 1 if g.active else 0) for g in scouts])
+
+    cstats = get_cache_stats()
+    lookups = cstats['hits'] + cstats['misses']
+    metric('pgscout_cache_hits_total', 'counter', 'Encounter cache hits.', [([], cstats['hits'])])
+    metric('pgscout_cache_misses_total', 'counter', 'Encounter cache misses.', [([], cstats['misses'])])
+    metric('pgscout_cache_hit_ratio', 'gauge', 'Share of encounter cache lookups that were hits.',
+           [([], float(cstats['hits']) / lookups if lookups else 0)])
+    metric('pgscout_cache_entries', 'gauge', 'Number of cached encounter results.', [([], cstats['entries'])])
+
+    hstats = cfg_get('hash_key_provider').get_stats()
+    metric('pgscout_hash_key_requests', 'gauge', 'Requests sent with each hash key in the last minute.',
+           [([('key', h['key'])], h['used']) for h in hstats])
+    metric('pgscout_hash_key_utilization', 'gauge', 'Share of the per minute quota of each hash key in use.',
+           [([('key', h['key'])], h['utilization']) for h in hstats])
+    metric('pgscout_hash_key_quota_errors_total', 'counter', 'Quota exceeded errors of each hash key.',
+           [([('key', h['key'])], h['quota_errors']) for h in hstats])
+
+    metric('pgscout_queue_depth', 'gauge', 'Number of jobs waiting for a scout.', [([], jobs.qsize())])
+    metric('pgscout_idle_scouts', 'gauge', 'Number of scouts waiting for a job.', [([], jobs.idle_count())])
+    metric('pgscout_expired_jobs_total', 'counter', 'Jobs dropped because their Pokemon despawns too soon.',
+           [([], jobs.num_expired)])
+
+    return '\n'.join(lines) + '\n'
+
+
+def histogram_metric(lines, name, help_text, label, keys, histograms):
+    lines.append('# HELP {} {}'.format(name, help_text))
+    lines.append('# TYPE {} histogram'.format(name))
+    for key in keys:
+        buckets, total, count = histograms[key]
+        for bound, bucket_count in zip(STAGE_BUCKETS, buckets):
+            lines.append('{}_bucket{} {}'.format(name, format_labels([(label, key), ('le', bound)]), bucket_count))
+        lines.append('{}_bucket{} {}'.format(name, format_labels([(label, key), ('le', '+Inf')]), count))
+        lines.append('{}_sum{} {}'.format(name, format_labels([(label, key)]), format_value(total)))
+        lines.append('{}_count{} {}'.format(name, format_labels([(label, key)]), count))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(u'{}="{}"'.format(k, escape_label(v)) for k, v in labels) + '}'
+
+
+def escape_label(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
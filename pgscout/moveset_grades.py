@@ -1,77 +1,83 @@
 import json
+import logging
 import os
+import sys
+import time
+from threading import Lock
 
-import requests
-from bs4 import BeautifulSoup
+log = logging.getLogger(__name__)
 
-from pgscout.utils import get_move_name
+# Compiled grade table built by pgscout-grades.py. Maps
+# (pokemon_id, move_1, move_2) to (offense, defense).
+moveset_grades = {}
+grades_mtime = None
+grades_lock = Lock()
 
-all_movesets = {}
+empty_grades = ('-', '-')
 
 
 # ===========================================================================
 
 
-def read_moveset_grades():
-    global all_movesets
-    with open('pokemon_moveset_grades.json', 'r') as infile:
-        all_movesets = json.load(infile)
-
-
-def write_moveset_grades():
-    with open('pokemon_moveset_grades.json', 'w') as outfile:
-        json.dump(all_movesets, outfile, indent=2)
-
-
-def get_moveset_grades(pokemon_id, pokemon_name, move1, move2):
-    global all_movesets
-    if not pokemon_name in all_movesets:
-        all_movesets[pokemon_name] = scrape_movesets(pokemon_id)
-        write_moveset_grades()
-
-    movesets = all_movesets.get(pokemon_name, {})
-    moveset_key = "{} / {}".format(get_move_name(move1), get_move_name(move2))
-    empty_moveset = {
-        'offense': '-',
-        'defense': '-'
-    }
-    result = empty_moveset.copy()
-    result.update(movesets.get(moveset_key, {}))
-    return result
-
-
-def scrape_movesets(pokemon_id):
+def read_grade_table(filename):
+    with open(filename, 'r') as infile:
+        data = json.load(infile)
+    table = {}
+    for pokemon_id, movesets in data.get('grades', {}).iteritems():
+        for moves, grades in movesets.iteritems():
+            move1, move2 = moves.split(',')
+            table[(int(pokemon_id), int(move1), int(move2))] = tuple(grades)
+    return table
+
+
+def write_grade_table(filename, table):
+    # Write to a temporary file first and rename it so readers always see
+    # either the old or the new complete table.
+    grades = {}
+    for (pokemon_id, move1, move2), moveset in table.iteritems():
+        grades.setdefault(str(pokemon_id), {})["{},{}".format(move1, move2)] = list(moveset)
+    tmp_filename = "{}.tmp".format(filename)
+    with open(tmp_filename, 'w') as outfile:
+        json.dump({'version': 1, 'updated': int(time.time()), 'grades': grades}, outfile, indent=1, sort_keys=True)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    if sys.platform == 'win32' and os.path.isfile(filename):
+        os.remove(filename)
+    os.rename(tmp_filename, filename)
+
+
+def load_moveset_grades(filename):
+    # Replaces the table in use if the file changed since it was loaded.
+    global moveset_grades, grades_mtime
+    if not os.path.isfile(filename):
+        if grades_mtime is None:
+            log.warning("Moveset grade table {} not found. Build it with pgscout-grades.py.".format(filename))
+            grades_mtime = 0
+        return False
+    mtime = os.path.getmtime(filename)
+    if mtime == grades_mtime:
+        return False
     try:
-        movesets = {}
-        r = requests.get('https://pokemongo.gamepress.gg/pokemon/{}'.format(pokemon_id))
-        soup = BeautifulSoup(r.text, "html.parser")
-
-        result = soup.find('div', 'view-moveset').div.table.tbody
-        for row in result.find_all('tr'):
-            qm_td = row.find('td', 'views-field-field-quick-move')
-            qm = qm_td.article.h2.a.span.text
-
-            cm_td = row.find('td', 'views-field-field-charge-move')
-            cm = cm_td.article.h2.a.span.text
-
-            off_grade_td = row.find('td', 'views-field-field-offensive-moveset-grade')
-            off_grade = off_grade_td.div.text
-
-            def_grade_td = row.find('td', 'views-field-field-defensive-moveset-grade')
-            def_grade = def_grade_td.div.text
-
-            moveset_key = "{} / {}".format(qm, cm)
-            movesets[moveset_key] = {
-                'offense': off_grade,
-                'defense': def_grade
-            }
-        return movesets
-    except:
-        return {}
-
-
-# ===========================================================================
-
-
-if os.path.isfile('pokemon_moveset_grades.json'):
-    read_moveset_grades()
+        table = read_grade_table(filename)
+    except Exception as e:
+        log.error("Could not read moveset grade table {}: {}".format(filename, repr(e)))
+        return False
+    with grades_lock:
+        moveset_grades = table
+        grades_mtime = mtime
+    log.info("Loaded {} moveset grades from {}.".format(len(table), filename))
+    return True
+
+
+def moveset_grades_reloader(filename, interval):
+    while True:
+        time.sleep(interval)
+        load_moveset_grades(filename)
+
+
+def get_moveset_grades(pokemon_id, move1, move2):
+    offense, defense = moveset_grades.get((pokemon_id, move1, move2), empty_grades)
+    return {
+        'offense': offense,
+        'defense': defense
+    }
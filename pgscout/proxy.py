@@ -3,16 +3,14 @@
 
 import logging
 import sys
-from threading import Thread
+import time
+from threading import Thread, Lock
 
 import requests
-from queue import Queue
+from queue import Queue, Empty
 
 log = logging.getLogger(__name__)
 
-# Last used proxy for round-robin.
-last_proxy = -1
-
 # Proxy check result constants.
 check_result_ok = 0
 check_result_failed = 1
@@ -23,84 +21,102 @@ check_result_exception = 5
 check_result_empty = 6
 check_result_max = 6  # Should be equal to maximal return code.
 
+
 # Simple function to do a call to Niantic's system for
-# testing proxy connectivity.
-def check_proxy(proxy_queue, timeout, working_proxies, check_results):
-
-    # Url for proxy testing.
-    proxy_test_url = 'https://pgorelease.nianticlabs.com/plfe/rpc'
-    proxy = proxy_queue.get()
-
-    check_result = check_result_ok
-
-    if proxy and proxy[1]:
-
-        log.debug('Checking proxy: %s', proxy[1])
-
-        try:
-            proxy_response = requests.post(proxy_test_url, '',
-                                           proxies={
-                                               'http': proxy[1],
-                                               'https': proxy[1]
-                                           },
-                                           timeout=timeout,
-                                           verify=False)
-
-            if proxy_response.status_code == 200:
-                log.debug('Proxy %s is ok.', proxy[1])
-                proxy_queue.task_done()
-                working_proxies.append(proxy[1])
-                check_results[check_result_ok] += 1
-                return True
-
-            elif proxy_response.status_code == 403:
-                proxy_error = ("Proxy " + proxy[1] +
-                               " is banned - got status code: " +
-                               str(proxy_response.status_code))
-                check_result = check_result_banned
-
-            else:
-                proxy_error = ("Wrong status code - " +
-                               str(proxy_response.status_code))
-                check_result = check_result_wrong
-
-        except requests.ConnectTimeout:
-            proxy_error = ("Connection timeout (" + str(timeout) +
-                           " second(s) ) via proxy " + proxy[1])
-            check_result = check_result_timeout
-
-        except requests.ConnectionError:
-            proxy_error = "Failed to connect to proxy " + proxy[1]
-            check_result = check_result_failed
-
-        except Exception as e:
-            proxy_error = e
-            check_result = check_result_exception
-
-    else:
-        proxy_error = "Empty proxy server."
-        check_result = check_result_empty
+# testing proxy connectivity. Returns check result and latency in seconds.
+def check_proxy(proxy, test_url, timeout):
 
-    log.warning('%s', repr(proxy_error))
-    proxy_queue.task_done()
+    if not proxy:
+        log.warning('Empty proxy server.')
+        return check_result_empty, None
 
-    check_results[check_result] += 1
-    return False
+    log.debug('Checking proxy: %s', proxy)
 
+    try:
+        start = time.time()
+        proxy_response = requests.post(test_url, '',
+                                       proxies={
+                                           'http': proxy,
+                                           'https': proxy
+                                       },
+                                       timeout=timeout,
+                                       verify=False)
+        latency = time.time() - start
+
+        if proxy_response.status_code == 200:
+            log.debug('Proxy %s is ok (%.2fs).', proxy, latency)
+            return check_result_ok, latency
+
+        elif proxy_response.status_code == 403:
+            proxy_error = ("Proxy " + proxy +
+                           " is banned - got status code: " +
+                           str(proxy_response.status_code))
+            check_result = check_result_banned
+
+        else:
+            proxy_error = ("Wrong status code - " +
+                           str(proxy_response.status_code))
+            check_result = check_result_wrong
+
+    except requests.ConnectTimeout:
+        proxy_error = ("Connection timeout (" + str(timeout) +
+                       " second(s) ) via proxy " + proxy)
+        check_result = check_result_timeout
+
+    except requests.ConnectionError:
+        proxy_error = "Failed to connect to proxy " + proxy
+        check_result = check_result_failed
+
+    except Exception as e:
+        proxy_error = e
+        check_result = check_result_exception
 
-# Check all proxies and return a working list with proxies.
-def check_proxies(proxies_file):
+    log.warning('%s', repr(proxy_error))
+    return check_result, None
 
-    source_proxies = []
 
+# Check a list of proxies with a bounded number of threads. Failed checks are
+# retried, banned proxies are not. Returns working proxies in their original
+# order, their latencies and the number of proxies per check result.
+def check_proxy_list(proxies, test_url, timeout, retries, num_threads):
+    proxy_queue = Queue()
+    for proxy in proxies:
+        proxy_queue.put(proxy)
+
+    latencies = {}
     check_results = [0] * (check_result_max + 1)
+    results_lock = Lock()
+
+    def worker():
+        while True:
+            try:
+                proxy = proxy_queue.get_nowait()
+            except Empty:
+                return
+            for attempt in range(retries + 1):
+                check_result, latency = check_proxy(proxy, test_url, timeout)
+                if check_result in [check_result_ok, check_result_banned, check_result_empty]:
+                    break
+            with results_lock:
+                check_results[check_result] += 1
+                if check_result == check_result_ok:
+                    latencies[proxy] = latency
+
+    threads = []
+    for i in range(min(num_threads, len(proxies))):
+        t = Thread(target=worker, name='check_proxy_{}'.format(i))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
 
-    # Load proxies from the file if such a file is configured.
-    if not proxies_file:
-        return source_proxies
+    working_proxies = [p for p in proxies if p in latencies]
+    return working_proxies, latencies, check_results
 
-    log.info('Loading proxies from file {}.'.format(proxies_file))
 
+def load_proxies(proxies_file):
+    source_proxies = []
     try:
         with open(proxies_file) as f:
             for line in f:
@@ -110,50 +126,70 @@ def check_proxies(proxies_file):
                 source_proxies.append(line.strip())
     except IOError:
         log.error('Could not load proxies from {}.'.format(proxies_file))
-        return []
+        return None
+    return source_proxies
 
-    log.info('Loaded {} proxies.'.format(len(source_proxies)))
 
-    if len(source_proxies) == 0:
-        log.error('Proxy file {} was configured but ' +
-                  'no proxies were loaded. Aborting.'.format(proxies_file))
-        sys.exit(1)
+def log_check_results(working_proxies, check_results, total_proxies):
+    other_fails = (check_results[check_result_failed] +
+                   check_results[check_result_wrong] +
+                   check_results[check_result_exception] +
+                   check_results[check_result_empty])
+    log.info('Proxy check completed. Working: %d, banned: %d, ' +
+             'timeout: %d, other fails: %d of total %d configured.',
+             len(working_proxies), check_results[check_result_banned],
+             check_results[check_result_timeout],
+             other_fails,
+             total_proxies)
 
-    proxy_queue = Queue()
-    total_proxies = len(source_proxies)
 
-    log.info('Checking proxies...')
+# Check all proxies and return a working list with proxies and their
+# latencies.
+def check_proxies(proxies_file, test_url, timeout, retries, num_threads):
 
-    working_proxies = []
+    # Load proxies from the file if such a file is configured.
+    if not proxies_file:
+        return [], {}
 
-    for proxy in enumerate(source_proxies):
-        proxy_queue.put(proxy)
+    log.info('Loading proxies from file {}.'.format(proxies_file))
 
-        t = Thread(target=check_proxy,
-                   name='check_proxy',
-                   args=(proxy_queue, 5, working_proxies, check_results))
-        t.daemon = True
-        t.start()
+    source_proxies = load_proxies(proxies_file)
+    if source_proxies is None:
+        return [], {}
+
+    log.info('Loaded {} proxies.'.format(len(source_proxies)))
+
+    if len(source_proxies) == 0:
+        log.error('Proxy file {} was configured but '.format(proxies_file) +
+                  'no proxies were loaded. Aborting.')
+        sys.exit(1)
 
-    # This is painful but we need to wait here until proxy_queue is
-    # completed so we have a working list of proxies.
-    proxy_queue.join()
+    log.info('Checking proxies...')
 
-    num_working_proxies = len(working_proxies)
+    working_proxies, latencies, check_results = check_proxy_list(
+        source_proxies, test_url, timeout, retries, num_threads)
 
-    if num_working_proxies == 0:
+    if len(working_proxies) == 0:
         log.error('Proxies were configured but no working ' +
                   'proxies were found. Aborting.')
         sys.exit(1)
-    else:
-        other_fails = (check_results[check_result_failed] +
-                       check_results[check_result_wrong] +
-                       check_results[check_result_exception] +
-                       check_results[check_result_empty])
-        log.info('Proxy check completed. Working: %d, banned: %d, ' +
-                 'timeout: %d, other fails: %d of total %d configured.',
-                 num_working_proxies, check_results[check_result_banned],
-                 check_results[check_result_timeout],
-                 other_fails,
-                 total_proxies)
-        return working_proxies
+
+    log_check_results(working_proxies, check_results, len(source_proxies))
+    return working_proxies, latencies
+
+
+# Check the proxy file again every interval seconds and replace the proxies
+# of the manager with the working ones. Picks up changes of the file too.
+def proxy_revalidator(proxy_manager, proxies_file, interval, test_url, timeout, retries, num_threads):
+    while True:
+        time.sleep(interval)
+        source_proxies = load_proxies(proxies_file)
+        if not source_proxies:
+            continue
+        working_proxies, latencies, check_results = check_proxy_list(
+            source_proxies, test_url, timeout, retries, num_threads)
+        log_check_results(working_proxies, check_results, len(source_proxies))
+        if len(working_proxies) == 0:
+            log.error('No working proxies left. Keeping the previous ones.')
+            continue
+        proxy_manager.set_proxies(working_proxies, latencies)
@@ -0,0 +1,104 @@
+import logging
+import random
+import time
+from collections import deque
+from threading import Lock
+
+from pgscout.Scout import Scout
+from pgscout.config import cfg_get
+from pgscout.utils import load_pgpool_accounts
+
+log = logging.getLogger(__name__)
+
+# Logged in scouts waiting to replace a banned one as (refreshed, scout),
+# least recently refreshed first
+standby_scouts = deque()
+standby_lock = Lock()
+
+
+def get_standby_count():
+    return len(standby_scouts)
+
+
+def take_standby_scout():
+    # Returns the most recently refreshed scout or None if there is none left.
+    with standby_lock:
+        return standby_scouts.pop()[1] if standby_scouts else None
+
+
+def put_standby_scout(scout):
+    with standby_lock:
+        standby_scouts.append((time.time(), scout))
+
+
+def take_stale_standby_scout():
+    # Returns a scout that was not refreshed for --standby-refresh minutes.
+    if not cfg_get('standby_refresh'):
+        return None
+    with standby_lock:
+        if standby_scouts and standby_scouts[0][0] < time.time() - cfg_get('standby_refresh') * 60:
+            return standby_scouts.popleft()[1]
+    return None
+
+
+def login_scout(scout, position):
+    scout.set_position(position[0], position[1], random.randint(12, 108))
+    try:
+        return scout.check_login()
+    except Exception as e:
+        scout.log_error("Login failed: {}".format(repr(e)))
+        return False
+
+
+def refresh_scout(scout):
+    # Tells PGPool the account is still in use, otherwise it gets released
+    # after a while, and makes sure the session is still valid.
+    try:
+        scout.update_pgpool()
+        return scout.check_login()
+    except Exception as e:
+        scout.log_error("Standby refresh failed: {}".format(repr(e)))
+        return False
+
+
+def standby_refiller(scouts, job_queue):
+    # Keeps --standby-accounts accounts from PGPool logged in. They log in
+    # where scouts were last busy and get refreshed while waiting.
+    while True:
+        scout = take_stale_standby_scout()
+        if scout:
+            if refresh_scout(scout):
+                put_standby_scout(scout)
+            else:
+                log.warning("Standby account {} failed refresh, replacing it.".format(scout.username))
+                scout.release_account(scout.last_msg)
+            continue
+
+        if get_standby_count() >= cfg_get('standby_accounts'):
+            time.sleep(5)
+            continue
+        positions = [s.acc.last_position for s in scouts if s.acc.last_position]
+        if not positions:
+            # Nowhere to log in yet
+            time.sleep(5)
+            continue
+
+        try:
+            acc = load_pgpool_accounts(1)
+        except Exception as e:
+            log.error("Could not load standby account from PGPool: {}".format(repr(e)))
+            time.sleep(30)
+            continue
+        if isinstance(acc, list):
+            acc = acc[0] if acc else None
+        if not acc:
+            log.warning("PGPool has no accounts left for standby.")
+            time.sleep(60)
+            continue
+
+        scout = Scout(acc['auth_service'], acc['username'], acc['password'], job_queue)
+        if login_scout(scout, random.choice(positions)):
+            put_standby_scout(scout)
+            log.info("Standby account {} ready, {} waiting.".format(scout.username, get_standby_count()))
+        else:
+            scout.release_account(scout.last_msg)
@@ -0,0 +1,91 @@
+import logging
+import time
+from Queue import Queue, Empty
+from threading import Thread, Lock
+
+from pgscout.config import cfg_get
+from pgscout.standby import login_scout
+from pgscout.utils import app_state
+
+log = logging.getLogger(__name__)
+
+login_state = {
+    'total': 0,
+    'ready': 0,
+    'failed': 0,
+    # Whether the eager login phase is still running
+    'starting': False
+}
+login_lock = Lock()
+
+
+def get_login_state():
+    return dict(login_state)
+
+
+def start_eager_login(scouts):
+    # Rejects requests until enough scouts are logged in.
+    login_state.update(total=len(scouts), ready=0, failed=0, starting=True)
+    app_state.accept_new_requests = False
+    log.info("Logging in {} scouts before accepting requests.".format(len(scouts)))
+    t = Thread(target=eager_login, name="eager_login", args=(list(scouts),))
+    t.daemon = True
+    t.start()
+
+
+def eager_login(scouts):
+    # Logs in all scouts before they take jobs. At most --eager-login-threads
+    # logins run at once and they start --eager-login-delay seconds apart.
+    # Each scout starts taking jobs right after its own login. Requests are
+    # accepted once --ready-fraction of the scouts are logged in.
+    lat, lng = map(float, cfg_get('eager_login_location').split(','))
+
+    queue = Queue()
+    for scout in scouts:
+        queue.put(scout)
+    schedule = {'next_start': time.time()}
+
+    def worker():
+        while True:
+            try:
+                scout = queue.get_nowait()
+            except Empty:
+                return
+            with login_lock:
+                wait = schedule['next_start'] - time.time()
+                schedule['next_start'] = max(time.time(), schedule['next_start']) + cfg_get('eager_login_delay')
+            if wait > 0:
+                time.sleep(wait)
+
+            success = login_scout(scout.acc, (lat, lng))
+            t = Thread(target=scout.run)
+            t.daemon = True
+            t.start()
+            with login_lock:
+                login_state['ready' if success else 'failed'] += 1
+                check_ready()
+
+    threads = []
+    for i in range(min(cfg_get('eager_login_threads'), len(scouts))):
+        t = Thread(target=worker, name='eager_login_{}'.format(i))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    with login_lock:
+        if login_state['starting']:
+            # Not enough scouts could log in, use what is there.
+            log.warning("Only {} of {} scouts logged in. Accepting requests anyway.".format(
+                login_state['ready'], login_state['total']))
+            login_state['starting'] = False
+            app_state.accept_new_requests = True
+    log.info("Eager login done: {} scouts ready, {} failed.".format(login_state['ready'], login_state['failed']))
+
+
+def check_ready():
+    if login_state['starting'] and login_state['ready'] >= cfg_get('ready_fraction') * login_state['total']:
+        login_state['starting'] = False
+        app_state.accept_new_requests = True
+        log.info("{} of {} scouts logged in. Accepting requests.".format(login_state['ready'], login_state['total']))
@@ -1,10 +1,12 @@
 import json
 import logging
+import math
 import os
 from base64 import b64decode
 
 import psutil
 import requests
+from mrmime.shadowbans import COMMON_POKEMON
 
 from pgscout.config import cfg_get
 from pgscout.AppState import AppState
@@ -48,11 +50,25 @@ def get_pokemon_name(pokemon_id):
     return get_pokemon_name.pokemon[str(pokemon_id)]
 
 
-def get_move_name(move_id):
-    if not hasattr(get_move_name, 'mapping'):
-        with open("pokemon_moves.json", 'r') as f:
-            get_move_name.mapping = json.loads(f.read())
-    return get_move_name.mapping.get(str(move_id))
+def get_pokemon_priority(pokemon_id):
+    # Priority from --priority-file if given, otherwise rare Pokemon come first
+    if not hasattr(get_pokemon_priority, 'priorities'):
+        get_pokemon_priority.priorities = {}
+        if cfg_get('priority_file'):
+            with open(cfg_get('priority_file'), 'r') as f:
+                get_pokemon_priority.priorities = json.loads(f.read())
+    priority = get_pokemon_priority.priorities.get(str(pokemon_id))
+    if priority is None:
+        priority = 0 if pokemon_id in COMMON_POKEMON else 1
+    return int(priority)
+
+
+def parse_despawn_time(value):
+    # Accepts Unix timestamps in seconds or milliseconds
+    if not value:
+        return None
+    value = float(value)
+    return value / 1000 if value > 10000000000 else value
 
 
 def calc_pokemon_level(cp_multiplier):
@@ -68,6 +84,22 @@ def calc_iv(at, df, st):
     return float(at + df + st) / 45 * 100
 
 
+def estimate_queue_wait(scouts, jobs):
+    # Seconds a new job would wait in the queue at the current scouting rate.
+    # None if there is no measured rate yet.
+    rate = sum(s.acc.encounters_per_hour for s in scouts if s.active) / 3600.0
+    if rate <= 0:
+        return None
+    return jobs.qsize() / rate
+
+
+def get_distance(lat1, lng1, lat2, lng2):
+    # Haversine distance in meters. Much faster than geopy and precise enough.
+    lat1, lng1, lat2, lng2 = map(math.radians, [lat1, lng1, lat2, lng2])
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+
 def load_pgpool_accounts(count, reuse=False):
     addl_text = " Reusing previous accounts." if reuse else ""
     log.info("Trying to load {} accounts from PGPool.{}".format(count, addl_text))
@@ -79,3 +111,12 @@ def load_pgpool_accounts(count, reuse=False):
     }
     r = requests.get("{}/account/request".format(cfg_get('pgpool_url')), params=request)
     return r.json()
+
+
+def grid_cell(lat, lng, cell_size):
+    return int(math.floor(lat / cell_size)), int(math.floor(lng / cell_size))
+
+
+def cell_width(lat, cell_size):
+    # Width of a grid cell in meters. Longitude cells shrink towards the poles.
+    return cell_size * 111320 * max(math.cos(math.radians(lat)), 0.01)
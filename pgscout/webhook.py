@@ -0,0 +1,48 @@
+import logging
+import time
+from Queue import Queue, Empty
+
+import requests
+
+from pgscout.config import cfg_get
+
+log = logging.getLogger(__name__)
+
+webhook_queue = Queue()
+
+
+def send_webhook(job):
+    # Done callback for jobs of the asynchronous API.
+    webhook_queue.put(dict(job.result, job_id=job.id))
+
+
+def webhook_sender():
+    # Collects results into batches and posts them to the webhook URL.
+    while True:
+        batch = [webhook_queue.get()]
+        deadline = time.time() + cfg_get('webhook_interval')
+        while len(batch) < cfg_get('webhook_batch_size'):
+            try:
+                batch.append(webhook_queue.get(timeout=max(0, deadline - time.time())))
+            except Empty:
+                break
+        post_batch(batch)
+
+
+def post_batch(batch):
+    retries = cfg_get('webhook_retries')
+    for attempt in range(retries + 1):
+        try:
+            r = requests.post(cfg_get('webhook_url'), json=batch, timeout=cfg_get('webhook_timeout'))
+            if r.status_code < 300:
+                return True
+            error = "status code {}".format(r.status_code)
+        except Exception as e:
+            error = repr(e)
+        if attempt < retries:
+            backoff = 2 ** attempt
+            log.warning("Webhook with {} results failed ({}). Retrying in {} seconds.".format(
+                len(batch), error, backoff))
+            time.sleep(backoff)
+    log.error("Giving up on webhook with {} results after {} tries: {}".format(len(batch), retries + 1, error))
+    return False